@@ -1,89 +1,151 @@
 import hashlib
 import json
+import threading
 import time
 from datetime import datetime
 from typing import Dict, Optional
 
+from chainstore import ChainStore, LazyChain
+from codec import VERSION, block_hash
+from history import HistoryIndex, block_messages
+from merkle import merkle_root
+from verify import find_invalid_block
+
 class Block:
-    def __init__(self, index: int, timestamp: str, data: dict, previous_hash: str):
+    # The hash is kept as its 32 raw bytes; .hash gives the hex string
+    __slots__ = ("index", "timestamp", "data", "previous_hash", "version", "digest")
+
+    def __init__(self, index: int, timestamp: str, data: dict, previous_hash: str, hash: Optional[str] = None,
+                 version: int = VERSION):
         self.index = index
         self.timestamp = timestamp
         self.data = data
         self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self) -> str:
-        block_string = json.dumps({
-            "index": self.index,
-            "timestamp": self.timestamp,
-            "data": self.data,
-            "previous_hash": self.previous_hash,
-        }, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        # 0 for legacy blocks hashed over JSON, see codec.py
+        self.version = version
+        # Stored blocks keep their stored hash until the chain is verified
+        self.hash = hash or self.calculate_hash()
+
+    @property
+    def hash(self) -> str: return self.digest.hex()
+
+    @hash.setter
+    def hash(self, value: str): self.digest = bytes.fromhex(value)
+
+    @classmethod
+    def from_dict(cls, block: dict) -> "Block":
+        return cls(block['index'], block['timestamp'], block['data'], block['previous_hash'], block.get('hash'),
+                   block.get('version', 0))
+
+    def fields(self) -> dict:
+        # Legacy records have no "version" key, so they are stored as before
+        fields = {"version": self.version} if self.version else {}
+        fields.update(index=self.index, timestamp=self.timestamp, data=self.data, previous_hash=self.previous_hash)
+        return fields
+
+    def calculate_hash(self) -> str: return block_hash(self.fields())
     
-    def to_dict(self) -> dict:
-        return {
-            "index": self.index,
-            "timestamp": self.timestamp,
-            "data": self.data,
-            "previous_hash": self.previous_hash,
-            "hash": self.hash,
-        }
+    def to_dict(self) -> dict: return dict(self.fields(), hash=self.hash)
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, tamper_detection: bool = False, verify_workers: Optional[int] = None,
+                 batch_size: int = 500, batch_interval: float = 0.2):
         self.chain = []
         self.users = {} 
+        self.store = ChainStore()
+        # Highest index whose hash and link have been checked. Stored blocks
+        # are trusted on load and appends only check the new block, unless
+        # tamper_detection re-verifies everything
+        self.verified_index = -1
+        self.tamper_detection = tamper_detection
+        self.verify_workers = verify_workers
+        # Messages wait here until batch_size are pending or batch_interval
+        # seconds pass, then they are sealed into one block
+        self.pending = []
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.pending_lock = threading.RLock()
+        # Held while a batch is sealed, so batches reach the chain in the
+        # order they were taken without holding up new messages
+        self.seal_lock = threading.Lock()
+        # Held for every change to the chain or users; always taken after
+        # pending_lock, never before it
+        self.chain_lock = threading.RLock()
+        self.seal_timer = None
+        # Secondary indexes for get_chat_history. Built on the first query, not
+        # at startup, and caught up with new blocks by each query after it
+        self.history = HistoryIndex()
         self.load_chain()
         self.load_users()
+        if tamper_detection: self.is_chain_valid(full=True)
+        else: self.verified_index = len(self.chain) - 1
 
         if not self.chain:
             self.create_genesis_block()
 
     def create_genesis_block(self):
-        genesis_block = Block(0, str(datetime.now()), {"username": "System", "message": "Genesis Block"}, "0")
+        genesis_block = Block(0, str(datetime.now()), {"username": "System", "message": "Genesis Block"}, "0" * 64)
         self.chain.append(genesis_block)
         self.save_chain()
 
     def add_block(self, data: dict):
-        previous_block = self.chain[-1]
-        new_block = Block(
-            index=len(self.chain),
-            timestamp=str(datetime.now()),
-            data=data,
-            previous_hash=previous_block.hash
-        )
-        if self.is_chain_valid():
-            self.chain.append(new_block)
-            self.save_chain()
-        else: raise ValueError("Blockchain is invalid - cannot add new block")
-
-    def is_chain_valid(self) -> bool:
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
-
-            if current_block.hash != current_block.calculate_hash(): return False
-            if current_block.previous_hash != previous_block.hash: return False
-        return True
+        with self.chain_lock:
+            previous_block = self.chain[-1]
+            new_block = Block(
+                index=len(self.chain),
+                timestamp=str(datetime.now()),
+                data=data,
+                previous_hash=previous_block.hash
+            )
+            if self.is_chain_valid(full=self.tamper_detection):
+                self.chain.append(new_block)
+                self.verified_index = new_block.index
+                self.save_chain()
+                return new_block
+            else: raise ValueError("Blockchain is invalid - cannot add new block")
+
+    def submit_message(self, data: dict):
+        with self.pending_lock:
+            self.pending.append(data)
+            full = len(self.pending) >= self.batch_size
+            if not full and self.seal_timer is None:
+                self.seal_timer = threading.Timer(self.batch_interval, self.seal_pending)
+                self.seal_timer.daemon = True
+                self.seal_timer.start()
+        if full: self.seal_pending()
+
+    def seal_pending(self) -> Optional[Block]:
+        with self.seal_lock:
+            with self.pending_lock:
+                if self.seal_timer is not None:
+                    self.seal_timer.cancel()
+                    self.seal_timer = None
+                if not self.pending: return None
+                messages, self.pending = self.pending, []
+            # Sealed outside pending_lock so messages can still be queued meanwhile
+            try: block = self.add_block({"messages": messages, "merkle_root": merkle_root(messages)})
+            except ValueError:
+                # Put back ahead of anything queued since, so none are lost
+                with self.pending_lock: self.pending[:0] = messages
+                raise
+        return block
+
+    def is_chain_valid(self, full: bool = False) -> bool:
+        # Start from the verified tip so the new blocks' links are checked too
+        start = 0 if full else max(self.verified_index, 0)
+        records = (self.chain[i].to_dict() for i in range(start, len(self.chain)))
+        bad_index = find_invalid_block(records, self.verify_workers)
+        if bad_index is None:
+            self.verified_index = len(self.chain) - 1
+            return True
+        self.verified_index = start + bad_index - 1
+        return False
 
     def save_chain(self):
-        chain_data = [block.to_dict() for block in self.chain]
-        with open("blockchain.json", "w") as f: json.dump(chain_data, f)
+        # Only blocks past the end of the log are written
+        for block in self.chain[len(self.store):]: self.store.append(block.to_dict())
 
-    def load_chain(self):
-        try:
-            with open("blockchain.json", "r") as f:
-                chain_data = json.load(f)
-                self.chain = [
-                    Block(
-                        index=block['index'],
-                        timestamp=block['timestamp'],
-                        data=block['data'],
-                        previous_hash=block['previous_hash']
-                    ) for block in chain_data
-                ]
-        except FileNotFoundError: pass
+    def load_chain(self): self.chain = LazyChain(self.store, Block.from_dict)
 
     def save_users(self):
         with open("users.json", "w") as f:
@@ -96,16 +158,28 @@ class Blockchain:
         except FileNotFoundError: pass
 
     def register_user(self, username: str, password: str):
-        if username in self.users:
-            raise ValueError("Username already exists")
-        self.users[username] = hashlib.sha256(password.encode()).hexdigest()
-        self.save_users()
+        with self.chain_lock:
+            if username in self.users:
+                raise ValueError("Username already exists")
+            self.users[username] = hashlib.sha256(password.encode()).hexdigest()
+            self.save_users()
 
     def authenticate_user(self, username: str, password: str) -> bool:
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         return self.users.get(username) == password_hash
 
-    def get_chat_history(self) -> list: return [block.data for block in self.chain[1:]]  
+    def index_history(self):
+        # One block at a time; slicing the lazy chain would build every block at once
+        with self.chain_lock: self.history.extend(self.chain[i] for i in range(self.history.blocks, len(self.chain)))
+
+    def get_chat_history(self, user: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                         query: Optional[str] = None, limit: Optional[int] = None) -> list:
+        # Messages from `user`, sent in [since, until) and containing every
+        # word of `query`, oldest first; the latest `limit` if one is given
+        with self.chain_lock:
+            self.index_history()
+            refs = self.history.search(user, since, until, query, limit)
+            return [block_messages(self.chain[index].data)[position] for index, position in refs]
 
 if __name__ == "__main__":
     blockchain = Blockchain()
@@ -136,17 +210,21 @@ if __name__ == "__main__":
                 print("Please login first")
                 continue
             message = input("Message: ")
-            blockchain.add_block({
+            blockchain.submit_message({
                 "username": current_user,
                 "message": message
             })
             print("Message sent!")
 
         elif choice == "4":
-            for message in blockchain.get_chat_history():
+            blockchain.seal_pending()
+            user = input("From user (blank for everyone): ")
+            query = input("Containing words (blank for all): ")
+            for message in blockchain.get_chat_history(user=user or None, query=query or None):
                 print(f"[{message['username']}]: {message['message']}")
 
         elif choice == "5":
+            blockchain.seal_pending()
             break
 
         else:
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import struct
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+# Blocks with "version": 1 are hashed over this binary encoding. Records
+# without a version are legacy blocks, hashed over their sort_keys JSON.
+VERSION = 1
+# version, index, timestamp (microseconds since EPOCH), previous hash, payload length
+HEADER = struct.Struct(">BQq32sI")
+# The payload starts with its kind: canonical JSON for any data, or a batch
+# of {"username", "message"} dicts packed as a count, all the username and
+# message lengths, all the usernames, all the messages and the Merkle root
+JSON_PAYLOAD, BATCH_PAYLOAD = 0, 1
+COUNT = struct.Struct(">I")
+# Wire frames: body length and the block's hash, then the body
+FRAME = struct.Struct(">I32s")
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+def is_batch(data) -> bool:
+    if type(data) is not dict or data.keys() != {"messages", "merkle_root"} or type(data["messages"]) is not list: return False
+    root = data["merkle_root"]
+    if type(root) is not str or len(root) != 64 or root.lower() != root: return False
+    try: bytes.fromhex(root)
+    except ValueError: return False
+    return all(type(m) is dict and len(m) == 2 and type(m.get("username")) is str and type(m.get("message")) is str
+               for m in data["messages"])
+
+def encode_payload(data) -> bytes:
+    if not is_batch(data):
+        return bytes([JSON_PAYLOAD]) + json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+    messages = data["messages"]
+    usernames = [m["username"].encode() for m in messages]
+    texts = [m["message"].encode() for m in messages]
+    lengths = struct.pack(f">{2 * len(messages)}I", *map(len, usernames), *map(len, texts))
+    return b"".join((bytes([BATCH_PAYLOAD]), COUNT.pack(len(messages)), lengths,
+                     b"".join(usernames), b"".join(texts), bytes.fromhex(data["merkle_root"])))
+
+def decode_payload(payload: bytes):
+    if payload[0] == JSON_PAYLOAD: return json.loads(payload[1:])
+    if payload[0] != BATCH_PAYLOAD: raise ValueError(f"unknown payload kind {payload[0]}")
+    (count,) = COUNT.unpack_from(payload, 1)
+    lengths = struct.unpack_from(f">{2 * count}I", payload, 1 + COUNT.size)
+    pos = 1 + COUNT.size + 8 * count
+    fields = []
+    for length in lengths:
+        fields.append(payload[pos:pos + length].decode())
+        pos += length
+    messages = [{"username": username, "message": text} for username, text in zip(fields[:count], fields[count:])]
+    return {"messages": messages, "merkle_root": payload[pos:pos + 32].hex()}
+
+def pack_timestamp(timestamp: str) -> int:
+    # Only timestamps that str(datetime) gives back unchanged are canonical
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is not None or str(moment) != timestamp: raise ValueError(f"timestamp {timestamp!r} is not canonical")
+    return (moment - EPOCH) // MICROSECOND
+
+def encode_block(record: dict) -> bytes:
+    payload = encode_payload(record["data"])
+    header = HEADER.pack(VERSION, record["index"], pack_timestamp(record["timestamp"]),
+                         bytes.fromhex(record["previous_hash"]), len(payload))
+    return header + payload
+
+def decode_block(body: bytes, block_hash: str) -> dict:
+    version, index, timestamp, previous_hash, length = HEADER.unpack_from(body)
+    if version != VERSION: raise ValueError(f"unknown block version {version}")
+    return {
+        "version": version,
+        "index": index,
+        "timestamp": str(EPOCH + timestamp * MICROSECOND),
+        "data": decode_payload(body[HEADER.size:HEADER.size + length]),
+        "previous_hash": previous_hash.hex(),
+        "hash": block_hash,
+    }
+
+def legacy_hash(record: dict) -> str:
+    block_string = json.dumps({
+        "index": record["index"],
+        "timestamp": record["timestamp"],
+        "data": record["data"],
+        "previous_hash": record["previous_hash"],
+    }, sort_keys=True).encode()
+    return hashlib.sha256(block_string).hexdigest()
+
+def block_hash(record: dict) -> str:
+    version = record.get("version", 0)
+    if version == 0: return legacy_hash(record)
+    if version == VERSION: return hashlib.sha256(encode_block(record)).hexdigest()
+    raise ValueError(f"unknown block version {version}")
+
+def encode_frame(record: dict) -> bytes:
+    # v1 blocks travel binary; legacy ones as a 0 byte and their JSON
+    if record.get("version", 0) == VERSION: body = encode_block(record)
+    else: body = b"\x00" + json.dumps(record).encode()
+    return FRAME.pack(len(body), bytes.fromhex(record["hash"])) + body
+
+def iter_frames(chunks: Iterable[bytes]) -> Iterator[dict]:
+    # Decode a stream of frames one record at a time, e.g. from response.iter_content()
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while len(buffer) - pos >= FRAME.size:
+            length, digest = FRAME.unpack_from(buffer, pos)
+            end = pos + FRAME.size + length
+            if len(buffer) < end: break
+            body = bytes(buffer[pos + FRAME.size:end])
+            yield json.loads(body[1:]) if body[0] == 0 else decode_block(body, digest.hex())
+            pos = end
+        del buffer[:pos]
+    if buffer: raise ValueError("truncated frame at end of stream")
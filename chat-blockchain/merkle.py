@@ -0,0 +1,23 @@
+import hashlib
+import json
+from typing import List
+
+# Leaves and inner nodes are hashed with different prefixes so a leaf can
+# never be passed off as a node
+LEAF = b"\x00"
+NODE = b"\x01"
+
+def leaf_hash(item) -> bytes:
+    return hashlib.sha256(LEAF + json.dumps(item, sort_keys=True).encode()).digest()
+
+def next_level(level: List[bytes]) -> List[bytes]:
+    # An odd last node moves up unchanged instead of being paired with itself
+    paired = [hashlib.sha256(NODE + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2: paired.append(level[-1])
+    return paired
+
+def merkle_root(items: list) -> str:
+    level = [leaf_hash(item) for item in items]
+    if not level: return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1: level = next_level(level)
+    return level[0].hex()
@@ -1,31 +1,220 @@
-from flask import Flask, request, jsonify
-import requests
+import json
+import time
+
+from flask import Flask, Response, g, request, jsonify
 
 from chatblockchain import Blockchain, Block
+from codec import encode_frame
+from metrics import metrics
 
 app = Flask(__name__)
 blockchain = Blockchain()
 
+metrics.gauge("chat_chain_length", lambda: len(blockchain.chain))
+metrics.gauge("chat_mempool_messages", lambda: len(blockchain.pending))
+metrics.gauge("chat_peers", lambda: len(blockchain.peers))
+
+@app.before_request
+def start_timer():
+    if metrics.enabled: g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # Labelled by route pattern, not path, so /block_hash/<int:index> is one
+    # series. Streamed bodies are timed up to their first byte
+    if metrics.enabled and request.url_rule is not None and 'started' in g:
+        route = request.url_rule.rule
+        metrics.observe("chat_http_request_seconds", time.perf_counter() - g.started, route=route, method=request.method)
+        metrics.inc("chat_http_requests_total", route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.enabled:
+        return "Metrics are disabled", 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4'), 200
+
 @app.route('/add_block', methods=['POST'])
 def add_block():
     block_data = request.get_json()
+    # Repeats of a gossiped block are dropped before any hashing or validation
+    if blockchain.gossip.seen_before(block_data.get('hash')):
+        metrics.inc("chat_gossip_duplicates_total")
+        return "Block already seen", 200
     new_block = Block(
         index=block_data['index'],
         timestamp=block_data['timestamp'],
         data=block_data['data'],
-        previous_hash=block_data['previous_hash']
+        previous_hash=block_data['previous_hash'],
+        version=block_data.get('version', 0)
     )
     
-    if blockchain.is_chain_valid() and new_block.previous_hash == blockchain.chain[-1].hash:
-        blockchain.chain.append(new_block)
-        blockchain.save_chain()
-        blockchain.broadcast_block(new_block)
+    if block_data.get('hash', new_block.hash) != new_block.hash:
+        metrics.inc("chat_blocks_rejected_total", source="peer")
+        return "Invalid block", 400
+    origin_time = request.headers.get('X-Origin-Time')
+    if blockchain.append_block(new_block):
+        # Only blocks we took are remembered (by broadcast_block), so a block
+        # that arrived before its parent is still accepted when relayed again
+        blockchain.gossip.record_latency(origin_time)
+        blockchain.broadcast_block(new_block, origin_time)
         return "Block added", 200
     return "Invalid block", 400
 
+def well_formed(record) -> bool:
+    # The fields read before any hashing; bad values in the others make the
+    # hash check fail
+    return (type(record) is dict and type(record.get('index')) is int and record['index'] >= 0
+            and type(record.get('hash')) is str and type(record.get('previous_hash')) is str)
+
+@app.route('/add_blocks', methods=['POST'])
+def add_blocks():
+    records = request.get_json()
+    if not isinstance(records, list) or not all(well_formed(record) for record in records):
+        return "Invalid blocks", 400
+    if records and blockchain.gossip.seen_before(records[-1].get('hash')):
+        metrics.inc("chat_gossip_duplicates_total")
+        return "Blocks already seen", 200
+
+    new_records = blockchain.add_blocks(records)
+    if new_records is None:
+        return "Invalid blocks", 400
+    if new_records:
+        origin_time = request.headers.get('X-Origin-Time')
+        blockchain.gossip.record_latency(origin_time)
+        blockchain.broadcast_blocks(new_records, origin_time)
+    return f"{len(new_records)} blocks added", 200
+
+@app.route('/gossip/stats', methods=['GET'])
+def gossip_stats():
+    return jsonify(blockchain.gossip.stats()), 200
+
+STREAM_CHUNK_SIZE = 1 << 16
+
+def stream_blocks(start: int, stop: int):
+    # JSON array of stored records, sent in ~64KB pieces
+    buffer = bytearray(b'[')
+    for i, record in enumerate(blockchain.store.iter_raw(start, stop)):
+        if i: buffer += b','
+        buffer += record
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b']'
+    yield bytes(buffer)
+
+def stream_frames(start: int, stop: int):
+    # The same records in the binary frame format of codec.py
+    buffer = bytearray()
+    for record in blockchain.store.iter_raw(start, stop):
+        buffer += encode_frame(json.loads(record))
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer)
+
+KEEPALIVE_SECONDS = 15
+MAX_POLL_SECONDS = 60
+
+def stream_events(after: int):
+    # Server-sent events: one `block` event per record after `after`, then
+    # new ones as they are appended. A reorg below what was sent gives a
+    # `reorg` event with the fork index, and the blocks from there
+    seq = blockchain.feed.seq
+    sent = after
+    while True:
+        buffer = bytearray()
+        for i, record in enumerate(blockchain.store.iter_raw(sent + 1, len(blockchain.chain)), sent + 1):
+            buffer += b'id: %d\nevent: block\ndata: %s\n\n' % (i, record)
+            sent = i
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer: yield bytes(buffer)
+        seq, changed = blockchain.feed.wait(seq, KEEPALIVE_SECONDS)
+        if changed is None:
+            # Lets the server notice clients that went away
+            yield b': keepalive\n\n'
+        elif changed <= sent:
+            yield b'event: reorg\ndata: {"from": %d}\n\n' % changed
+            sent = changed - 1
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    # Blocks after index `after` (or the Last-Event-ID of a reconnecting
+    # EventSource); only new blocks by default
+    after = request.args.get('after', request.headers.get('Last-Event-ID', type=int), type=int)
+    if after is None:
+        after = len(blockchain.chain) - 1
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_events(max(after, -1)), mimetype='text/event-stream', headers=headers), 200
+
+@app.route('/poll', methods=['GET'])
+def poll():
+    # Long-poll: waits up to `timeout` seconds for blocks after index
+    # `after`, then answers like /get_chain with what there is
+    after = max(request.args.get('after', -1, type=int), -1)
+    timeout = min(max(request.args.get('timeout', 30, type=float), 0), MAX_POLL_SECONDS)
+    seq = blockchain.feed.seq
+    if len(blockchain.chain) <= after + 1:
+        blockchain.feed.wait(seq, timeout)
+    return Response(stream_blocks(after + 1, len(blockchain.chain)), mimetype='application/json'), 200
+
+@app.route('/messages', methods=['POST'])
+def send_message():
+    # Queued in the mempool; sealed into a block with other messages shortly
+    data = request.get_json()
+    if not data or not data.get('username') or 'message' not in data:
+        return "Invalid message", 400
+    blockchain.submit_message({'username': data['username'], 'message': data['message']})
+    return "Message queued", 202
+
+@app.route('/messages', methods=['GET'])
+def get_messages():
+    # Optional filters: user, since/until (ISO times, until exclusive), q
+    # (all words must appear) and limit (the latest N)
+    try:
+        messages = blockchain.get_chat_history(
+            user=request.args.get('user'),
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            query=request.args.get('q'),
+            limit=request.args.get('limit', type=int)
+        )
+    except ValueError as e:
+        return str(e), 400
+    return jsonify({'messages': messages, 'length': len(messages)}), 200
+
+@app.route('/users/<username>/messages', methods=['GET'])
+def get_user_messages(username):
+    messages = blockchain.get_chat_history(user=username, limit=request.args.get('limit', type=int))
+    return jsonify({'messages': messages, 'length': len(messages)}), 200
+
 @app.route('/get_chain', methods=['GET'])
 def get_chain():
-    return jsonify([block.to_dict() for block in blockchain.chain]), 200
+    # Blocks from index `from` up to (not including) `to`; the whole chain by
+    # default, as JSON or with format=binary as codec.py frames
+    length = len(blockchain.chain)
+    start = max(request.args.get('from', 0, type=int), 0)
+    stop = min(request.args.get('to', length, type=int), length)
+    if request.args.get('format') == 'binary':
+        return Response(stream_frames(start, stop), mimetype='application/octet-stream'), 200
+    return Response(stream_blocks(start, stop), mimetype='application/json'), 200
+
+@app.route('/height', methods=['GET'])
+def get_height():
+    with blockchain.chain_lock:
+        tip = blockchain.chain[-1]
+        length = len(blockchain.chain)
+    return jsonify({'height': tip.index, 'hash': tip.hash, 'length': length}), 200
+
+@app.route('/block_hash/<int:index>', methods=['GET'])
+def get_block_hash(index):
+    with blockchain.chain_lock:
+        if index >= len(blockchain.chain):
+            return "Block not found", 404
+        block_hash = blockchain.chain[index].hash
+    return jsonify({'index': index, 'hash': block_hash}), 200
 
 @app.route('/register_peer', methods=['POST'])
 def register_peer():
@@ -43,11 +232,7 @@ def register_node():
         return "Invalid address", 400
 
     # Register with existing network
-    for peer in blockchain.peers:
-        try:
-            requests.post(f"http://{peer}/register_peer", json={'address': new_node_address})
-        except requests.exceptions.RequestException:
-            continue
+    blockchain.client.fan_out("POST", blockchain.peers, "/register_peer", json={'address': new_node_address})
 
     blockchain.register_peer(new_node_address)
     return "Node registered with network", 200
@@ -71,10 +256,7 @@ if __name__ == '__main__':
     nodes = args.nodes or []
 
     # Register with existing network
-    for node in nodes:
-        try:
-            requests.post(f"http://{node}/register_node", json={'address': f'localhost:{port}'})
-        except requests.exceptions.RequestException:
-            continue
+    blockchain.client.fan_out("POST", nodes, "/register_node", json={'address': f'localhost:{port}'})
 
-    app.run(host='0.0.0.0', port=port)
+    # Request threads share one Blockchain; its locks keep them consistent
+    app.run(host='0.0.0.0', port=port, threaded=True)
@@ -0,0 +1,149 @@
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from chainstore import ChainStore
+from chatblockchain import Block, Blockchain
+from codec import VERSION, block_hash, encode_frame, iter_frames, legacy_hash
+from merkle import merkle_root
+
+# Codec, validation and storage microbenchmarks, then request latencies
+# through Flask's test client. Chains are written to temporary directories.
+# Results are printed and, with -o, written as JSON for comparing runs
+
+def make_record(messages: int) -> dict:
+    batch = [{"username": f"user{i % 50}", "message": f"message number {i}"} for i in range(messages)]
+    record = {
+        "version": VERSION,
+        "index": 1,
+        "timestamp": str(datetime.now()),
+        "data": {"messages": batch, "merkle_root": merkle_root(batch)},
+        "previous_hash": "ab" * 32,
+    }
+    record["hash"] = block_hash(record)
+    return record
+
+def per_sec(run: Callable[[], object], seconds: float) -> float:
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        run()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+def summary(samples: List[float]) -> dict:
+    samples = sorted(samples)
+    percentile = lambda p: samples[min(int(p * len(samples)), len(samples) - 1)] * 1000
+    return {"count": len(samples), "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": percentile(0.5), "p99_ms": percentile(0.99)}
+
+def timed(call: Callable[[], object], count: int) -> dict:
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = call()
+        samples.append(time.perf_counter() - start)
+        if response.status_code >= 400: raise RuntimeError(f"{response.status_code}: {response.get_data(as_text=True)}")
+    return summary(samples)
+
+def build_records(size: int, messages: int = 10) -> List[dict]:
+    chain = [Block(0, str(datetime.now()), {"username": "System", "message": "Genesis Block"}, "0" * 64)]
+    while len(chain) < size:
+        batch = [{"username": f"user{i % 50}", "message": f"message number {i}"} for i in range(messages)]
+        chain.append(Block(len(chain), str(datetime.now()), {"messages": batch, "merkle_root": merkle_root(batch)}, chain[-1].hash))
+    return [block.to_dict() for block in chain]
+
+def bench_codec(sizes: List[int], seconds: float) -> Dict[str, dict]:
+    results = {}
+    print(f"{'messages':>8} {'json bytes':>10} {'frame bytes':>11} {'legacy hash/s':>13} {'v1 hash/s':>10} {'encode/s':>10} {'decode/s':>10}")
+    for size in sizes:
+        record = make_record(size)
+        json_bytes = json.dumps(record).encode()
+        frame = encode_frame(record)
+        assert next(iter_frames([frame])) == record
+        result = results[str(size)] = {
+            "json_bytes": len(json_bytes),
+            "frame_bytes": len(frame),
+            "legacy_hash_per_sec": per_sec(lambda: legacy_hash(record), seconds),
+            "v1_hash_per_sec": per_sec(lambda: block_hash(record), seconds),
+            "encode_per_sec": per_sec(lambda: encode_frame(record), seconds),
+            "decode_per_sec": per_sec(lambda: next(iter_frames([frame])), seconds),
+        }
+        print(f"{size:>8} {len(json_bytes):>10} {len(frame):>11} {result['legacy_hash_per_sec']:>13,.0f} {result['v1_hash_per_sec']:>10,.0f}"
+              f" {result['encode_per_sec']:>10,.0f} {result['decode_per_sec']:>10,.0f}")
+    return results
+
+def bench_storage(records: List[dict], sizes: List[int]) -> Dict[str, dict]:
+    # Per chain length: writing the log in one run, opening it as a node
+    # does (index, history index), its peak memory, and full validation
+    results = {}
+    for size in sizes:
+        os.chdir(tempfile.mkdtemp())
+        store = ChainStore()
+        start = time.perf_counter()
+        store.append_many(records[:size])
+        save = time.perf_counter() - start
+        store.close()
+        start = time.perf_counter()
+        blockchain = Blockchain()
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        if not blockchain.is_chain_valid(full=True): raise RuntimeError(f"generated chain of {size} blocks is invalid")
+        validate = time.perf_counter() - start
+        blockchain.store.close()
+        tracemalloc.start()
+        Blockchain().store.close()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[str(size)] = {"save_seconds": save, "save_blocks_per_sec": size / save, "load_seconds": load,
+                              "load_blocks_per_sec": size / load, "load_peak_bytes": peak,
+                              "validate_seconds": validate, "validate_blocks_per_sec": size / validate}
+        print(f"{size:>8} blocks: save {size / save:,.0f}/s, load {size / load:,.0f}/s ({peak / 1e6:.1f} MB peak),"
+              f" is_chain_valid {size / validate:,.0f}/s")
+    return results
+
+def bench_http(count: int) -> Dict[str, dict]:
+    os.chdir(tempfile.mkdtemp())
+    from app import app, blockchain
+    client = app.test_client()
+    results = {}
+
+    def add_block():
+        tip = blockchain.chain[-1]
+        block = Block(tip.index + 1, str(datetime.now()), {"username": f"user{tip.index % 50}", "message": f"hello {tip.index}"}, tip.hash)
+        return client.post("/add_block", json=block.to_dict())
+    results["POST /add_block"] = timed(add_block, count)
+    results["POST /messages"] = timed(lambda: client.post("/messages", json={"username": "user1", "message": "hi"}), count)
+    blockchain.seal_pending()
+    results["GET /messages?user"] = timed(lambda: client.get("/messages", query_string={"user": "user7", "limit": 20}), count)
+    results["GET /messages?q"] = timed(lambda: client.get("/messages", query_string={"q": "hello", "limit": 20}), count)
+    results["GET /get_chain?from"] = timed(lambda: client.get("/get_chain", query_string={"from": len(blockchain.chain) - 10}), count)
+    results["GET /poll"] = timed(lambda: client.get("/poll", query_string={"after": len(blockchain.chain) - 2, "timeout": 0}), count)
+    results["GET /height"] = timed(lambda: client.get("/height"), count)
+    for route, result in results.items():
+        print(f"{route:<20} p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms")
+    return results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--sizes", nargs="*", default=[1, 10, 100, 1000], type=int, help="Messages per block")
+    parser.add_argument("-t", "--seconds", default=0.5, type=float, help="Time per measurement")
+    parser.add_argument("-c", "--chain-sizes", nargs="*", default=[1000, 10000, 100000], type=int, help="Chain lengths to store and validate")
+    parser.add_argument("-n", "--requests", default=500, type=int, help="Requests per route")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+    output = args.output and os.path.abspath(args.output)
+
+    results = {
+        "codec": bench_codec(args.sizes, args.seconds),
+        "storage": bench_storage(build_records(max(args.chain_sizes)), args.chain_sizes),
+        "http": bench_http(args.requests),
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump({"suite": "chat-http", "python": platform.python_version(), "results": results}, f, indent=2)
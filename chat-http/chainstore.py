@@ -0,0 +1,191 @@
+import json
+import mmap
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Iterator, List
+
+class ChainStore:
+    """Append-only block log.
+
+    Blocks are stored one JSON object per line in `path`, and `path + ".idx"`
+    holds the byte offset of every line as packed 64-bit integers. Adding a
+    block writes one line and one offset; fsync runs every `sync_every`
+    appends or on sync(). All reads and writes hold `lock`, so one store
+    can be shared by request threads.
+    """
+
+    def __init__(self, path: str = "blockchain.log", legacy_path: str = "blockchain.json", sync_every: int = 32):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.mapped = None
+        self.lock = threading.RLock()
+        migrate = not os.path.exists(path) and os.path.exists(legacy_path)
+        self.recover()
+        self.open_files()
+        if migrate: self.migrate(legacy_path)
+
+    def __len__(self) -> int: return len(self.offsets)
+
+    def open_files(self):
+        self.log = open(self.path, "ab")
+        self.index = open(self.index_path, "ab")
+        self.end = self.log.tell()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.unmap()
+            self.log.close()
+            self.index.close()
+
+    def unmap(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+    def remap(self):
+        self.unmap()
+        self.log.flush()
+        if self.end:
+            with open(self.path, "rb") as f: self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_raw(self, i: int) -> bytes:
+        with self.lock:
+            start = self.offsets[i]
+            end = self.offsets[i + 1] if i + 1 < len(self.offsets) else self.end
+            if self.mapped is None or end > len(self.mapped): self.remap()
+            return self.mapped[start:end - 1]
+
+    def read(self, i: int) -> dict: return json.loads(self.read_raw(i))
+
+    def iter_raw(self, start: int, stop: int) -> Iterator[bytes]:
+        # Records exactly as stored, for serving without building Blocks.
+        # Stops early if the log is truncated while iterating
+        for i in range(start, stop):
+            with self.lock:
+                if i >= len(self.offsets): return
+                record = self.read_raw(i)
+            yield record
+
+    def recover(self):
+        # The log is written before the index, so at most the last indexed
+        # record and anything after it can be torn. Re-scan from there and
+        # cut the log at the last complete line.
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        offsets = array('Q')
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f: data = f.read()
+            offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+        indexed = len(offsets)
+        while offsets and offsets[-1] >= size: offsets.pop()
+        good_end = offsets.pop() if offsets else 0
+
+        with open(self.path, "ab+") as f:
+            f.seek(good_end)
+            for line in f:
+                if not line.endswith(b"\n"): break
+                try: json.loads(line)
+                except ValueError: break
+                offsets.append(good_end)
+                good_end += len(line)
+            if good_end < size: f.truncate(good_end)
+
+        if len(offsets) != indexed or not os.path.exists(self.index_path):
+            with open(self.index_path, "wb") as f: offsets.tofile(f)
+        self.offsets = offsets
+
+    def migrate(self, legacy_path: str):
+        with open(legacy_path, "r") as f: self.append_many(json.load(f))
+
+    def append(self, record: dict, sync: bool = True):
+        line = json.dumps(record).encode() + b"\n"
+        with self.lock:
+            self.log.write(line)
+            self.offsets.append(self.end)
+            self.index.write(self.offsets[-1:].tobytes())
+            self.end += len(line)
+            self.unsynced += 1
+            if sync and self.unsynced >= self.sync_every: self.sync()
+            else:
+                self.log.flush()
+                self.index.flush()
+
+    def append_many(self, records: List[dict]):
+        # One write and one fsync for the whole run
+        lines = [json.dumps(record).encode() + b"\n" for record in records]
+        offsets = array('Q')
+        with self.lock:
+            for line in lines:
+                offsets.append(self.end)
+                self.end += len(line)
+            self.log.write(b"".join(lines))
+            self.index.write(offsets.tobytes())
+            self.offsets.extend(offsets)
+            self.unsynced += len(lines)
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            self.log.flush()
+            self.index.flush()
+            if self.unsynced:
+                os.fsync(self.log.fileno())
+                os.fsync(self.index.fileno())
+                self.unsynced = 0
+
+    def truncate(self, length: int):
+        # Cut the log before the index; recover() drops offsets past the log
+        with self.lock:
+            if length >= len(self.offsets): return
+            self.unmap()
+            self.log.flush()
+            self.index.flush()
+            self.end = self.offsets[length]
+            del self.offsets[length:]
+            self.log.truncate(self.end)
+            self.index.truncate(length * self.offsets.itemsize)
+            os.fsync(self.log.fileno())
+            os.fsync(self.index.fileno())
+
+class LazyChain:
+    """List-like view of the blocks in a ChainStore.
+
+    len() and indexing only touch the offset index and the one record they
+    need; blocks are built on first access and the most recent cache_size
+    are kept. Appending writes the block to the store.
+    """
+
+    def __init__(self, store: ChainStore, make_block: Callable[[dict], object], cache_size: int = 1024):
+        self.store = store
+        self.make_block = make_block
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self) -> int: return len(self.store)
+
+    def __getitem__(self, i):
+        with self.store.lock:
+            if isinstance(i, slice): return [self[j] for j in range(*i.indices(len(self)))]
+            if i < 0: i += len(self)
+            if not 0 <= i < len(self): raise IndexError("chain index out of range")
+            block = self.cache.get(i)
+            if block is None: block = self.remember(i, self.make_block(self.store.read(i)))
+            else: self.cache.move_to_end(i)
+            return block
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def remember(self, i: int, block):
+        self.cache[i] = block
+        if len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+        return block
+
+    def append(self, block):
+        with self.store.lock:
+            self.store.append(block.to_dict())
+            self.remember(len(self) - 1, block)
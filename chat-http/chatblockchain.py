@@ -1,91 +1,167 @@
 import hashlib
 import json
+import threading
 import time
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, Iterable, List, Optional
+
+from chainstore import ChainStore, LazyChain
+from codec import VERSION, block_hash, iter_frames
+from feed import BlockFeed
+from gossip import Gossip
+from history import HistoryIndex, block_messages
+from merkle import merkle_root
+from metrics import metrics
+from peers import PeerClient
+from verify import bad_merkle_root, find_invalid_block, iter_json_array
 
 class Block:
-    def __init__(self, index: int, timestamp: str, data: dict, previous_hash: str):
+    # The hash is kept as its 32 raw bytes; .hash gives the hex string
+    __slots__ = ("index", "timestamp", "data", "previous_hash", "version", "digest")
+
+    def __init__(self, index: int, timestamp: str, data: dict, previous_hash: str, hash: Optional[str] = None,
+                 version: int = VERSION):
         self.index = index
         self.timestamp = timestamp
         self.data = data
         self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self) -> str:
-        block_string = json.dumps({
-            "index": self.index,
-            "timestamp": self.timestamp,
-            "data": self.data,
-            "previous_hash": self.previous_hash,
-        }, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        # 0 for legacy blocks hashed over JSON, see codec.py
+        self.version = version
+        # Stored blocks keep their stored hash until the chain is verified
+        self.hash = hash or self.calculate_hash()
+
+    @property
+    def hash(self) -> str: return self.digest.hex()
+
+    @hash.setter
+    def hash(self, value: str): self.digest = bytes.fromhex(value)
+
+    @classmethod
+    def from_dict(cls, block: dict) -> "Block":
+        return cls(block['index'], block['timestamp'], block['data'], block['previous_hash'], block.get('hash'),
+                   block.get('version', 0))
+
+    def fields(self) -> dict:
+        # Legacy records have no "version" key, so they are stored as before
+        fields = {"version": self.version} if self.version else {}
+        fields.update(index=self.index, timestamp=self.timestamp, data=self.data, previous_hash=self.previous_hash)
+        return fields
+
+    def calculate_hash(self) -> str: return block_hash(self.fields())
     
-    def to_dict(self) -> dict:
-        return {
-            "index": self.index,
-            "timestamp": self.timestamp,
-            "data": self.data,
-            "previous_hash": self.previous_hash,
-            "hash": self.hash,
-        }
+    def to_dict(self) -> dict: return dict(self.fields(), hash=self.hash)
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, tamper_detection: bool = False, verify_workers: Optional[int] = None,
+                 batch_size: int = 500, batch_interval: float = 0.2):
         self.chain = []
         self.users = {}
         self.peers = set()
+        self.client = PeerClient()
+        self.gossip = Gossip()
+        # Wakes /stream and /poll subscribers on every change to the chain
+        self.feed = BlockFeed()
+        with metrics.timer("chat_store_io_seconds", op="load"): self.store = ChainStore()
+        # Highest index whose hash and link have been checked. Stored blocks
+        # are trusted on load and appends only check the new block, unless
+        # tamper_detection re-verifies everything
+        self.verified_index = -1
+        self.tamper_detection = tamper_detection
+        self.verify_workers = verify_workers
+        # Messages wait here until batch_size are pending or batch_interval
+        # seconds pass, then they are sealed into one block
+        self.pending = []
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.pending_lock = threading.RLock()
+        # Held while a batch is sealed, so batches reach the chain in the
+        # order they were taken without holding up new messages
+        self.seal_lock = threading.Lock()
+        # Held for every change to the chain or users; always taken after
+        # pending_lock, never before it
+        self.chain_lock = threading.RLock()
+        self.seal_timer = None
+        # Secondary indexes for get_chat_history. Built on the first query, not
+        # at startup, and caught up with new blocks by each query after it
+        self.history = HistoryIndex()
 
         self.load_chain()
         self.load_users()
+        if tamper_detection: self.is_chain_valid(full=True)
+        else: self.verified_index = len(self.chain) - 1
 
         if not self.chain: self.create_genesis_block()
 
     # Old methods
     def create_genesis_block(self):
-        genesis_block = Block(0, str(datetime.now()), {"username": "System", "message": "Genesis Block"}, "0")
+        genesis_block = Block(0, str(datetime.now()), {"username": "System", "message": "Genesis Block"}, "0" * 64)
         self.chain.append(genesis_block)
         self.save_chain()
 
     def add_block(self, data: dict):
-        previous_block = self.chain[-1]
-        new_block = Block(
-            index=len(self.chain),
-            timestamp=str(datetime.now()),
-            data=data,
-            previous_hash=previous_block.hash
-        )
-        if self.is_chain_valid():
-            self.chain.append(new_block)
-            self.save_chain()
-        else: raise ValueError("Blockchain is invalid - cannot add new block")
+        with self.chain_lock:
+            previous_block = self.chain[-1]
+            new_block = Block(
+                index=len(self.chain),
+                timestamp=str(datetime.now()),
+                data=data,
+                previous_hash=previous_block.hash
+            )
+            if self.is_chain_valid(full=self.tamper_detection):
+                # Appending writes the block to the store
+                with metrics.timer("chat_store_io_seconds", op="save"): self.chain.append(new_block)
+                self.verified_index = new_block.index
+                self.save_chain()
+                self.feed.publish(new_block.index)
+                metrics.inc("chat_blocks_accepted_total", source="local")
+                return new_block
+            else:
+                metrics.inc("chat_blocks_rejected_total", source="local")
+                raise ValueError("Blockchain is invalid - cannot add new block")
 
-    def is_chain_valid(self) -> bool:
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i-1]
+    def submit_message(self, data: dict):
+        with self.pending_lock:
+            self.pending.append(data)
+            full = len(self.pending) >= self.batch_size
+            if not full and self.seal_timer is None:
+                self.seal_timer = threading.Timer(self.batch_interval, self.seal_pending)
+                self.seal_timer.daemon = True
+                self.seal_timer.start()
+        if full: self.seal_pending()
 
-            if current_block.hash != current_block.calculate_hash(): return False
-            if current_block.previous_hash != previous_block.hash: return False
-        return True
+    def seal_pending(self) -> Optional[Block]:
+        with self.seal_lock:
+            with self.pending_lock:
+                if self.seal_timer is not None:
+                    self.seal_timer.cancel()
+                    self.seal_timer = None
+                if not self.pending: return None
+                messages, self.pending = self.pending, []
+            # Sealed outside pending_lock so messages can still be queued meanwhile
+            try: block = self.add_block({"messages": messages, "merkle_root": merkle_root(messages)})
+            except ValueError:
+                # Put back ahead of anything queued since, so none are lost
+                with self.pending_lock: self.pending[:0] = messages
+                raise
+        self.broadcast_block(block)
+        return block
+
+    def is_chain_valid(self, full: bool = False) -> bool:
+        # Start from the verified tip so the new blocks' links are checked too
+        start = 0 if full else max(self.verified_index, 0)
+        records = (self.chain[i].to_dict() for i in range(start, len(self.chain)))
+        with metrics.timer("chat_chain_validation_seconds", chain="local"): bad_index = find_invalid_block(records, self.verify_workers)
+        if bad_index is None:
+            self.verified_index = len(self.chain) - 1
+            return True
+        self.verified_index = start + bad_index - 1
+        return False
 
     def save_chain(self):
-        chain_data = [block.to_dict() for block in self.chain]
-        with open("blockchain.json", "w") as f: json.dump(chain_data, f)
+        # Only blocks past the end of the log are written
+        for block in self.chain[len(self.store):]: self.store.append(block.to_dict())
 
-    def load_chain(self):
-        try:
-            with open("blockchain.json", "r") as f:
-                chain_data = json.load(f)
-                self.chain = [
-                    Block(
-                        index=block['index'],
-                        timestamp=block['timestamp'],
-                        data=block['data'],
-                        previous_hash=block['previous_hash']
-                    ) for block in chain_data
-                ]
-        except FileNotFoundError: pass
+    def load_chain(self): self.chain = LazyChain(self.store, Block.from_dict)
 
     def save_users(self):
         with open("users.json", "w") as f:
@@ -98,53 +174,144 @@ class Blockchain:
         except FileNotFoundError: pass
 
     def register_user(self, username: str, password: str):
-        if username in self.users:
-            raise ValueError("Username already exists")
-        self.users[username] = hashlib.sha256(password.encode()).hexdigest()
-        self.save_users()
+        with self.chain_lock:
+            if username in self.users:
+                raise ValueError("Username already exists")
+            self.users[username] = hashlib.sha256(password.encode()).hexdigest()
+            self.save_users()
 
     def authenticate_user(self, username: str, password: str) -> bool:
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         return self.users.get(username) == password_hash
 
-    def get_chat_history(self) -> list: return [block.data for block in self.chain[1:]]  
+    def index_history(self):
+        # One block at a time; slicing the lazy chain would build every block at once
+        with self.chain_lock: self.history.extend(self.chain[i] for i in range(self.history.blocks, len(self.chain)))
+
+    def get_chat_history(self, user: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                         query: Optional[str] = None, limit: Optional[int] = None) -> list:
+        # Messages from `user`, sent in [since, until) and containing every
+        # word of `query`, oldest first; the latest `limit` if one is given
+        with self.chain_lock:
+            self.index_history()
+            refs = self.history.search(user, since, until, query, limit)
+            return [block_messages(self.chain[index].data)[position] for index, position in refs]
 
     # New methods
 
     def register_peer(self, address: str): self.peers.add(address)
 
-    def broadcast_block(self, block: Block):
-        for peer in self.peers: requests.post(f"http://{peer}/add_block", json=block.to_dict())
+    def append_block(self, block: Block) -> bool:
+        # Peer blocks are checked against the verified tip only
+        with self.chain_lock:
+            previous_block = self.chain[-1]
+            if (not self.is_chain_valid(full=self.tamper_detection) or block.index != previous_block.index + 1
+                    or block.previous_hash != previous_block.hash or bad_merkle_root(block.data)):
+                metrics.inc("chat_blocks_rejected_total", source="peer")
+                return False
+            with metrics.timer("chat_store_io_seconds", op="save"): self.chain.append(block)
+            self.verified_index = block.index
+            self.save_chain()
+            self.feed.publish(block.index)
+            metrics.inc("chat_blocks_accepted_total", source="peer")
+            return True
+
+    def add_blocks(self, records: List[dict]) -> Optional[List[dict]]:
+        # A run of peer blocks, checked against the tip in one pass and written
+        # with one fsync. Blocks we already have are skipped; returns the new
+        # ones, or None if the run doesn't extend our chain
+        added = self.extend_chain(records)
+        if added is None: metrics.inc("chat_blocks_rejected_total", len(records), source="peer")
+        else: metrics.inc("chat_blocks_accepted_total", len(added), source="peer")
+        return added
+
+    def extend_chain(self, records: List[dict]) -> Optional[List[dict]]:
+        with self.chain_lock:
+            known = [record for record in records if record['index'] < len(self.chain)]
+            if any(self.chain[record['index']].hash != record['hash'] for record in known): return None
+            records = records[len(known):]
+            if not records: return []
+            if not self.is_chain_valid(full=self.tamper_detection): return None
+            tip = self.chain[-1]
+            if any(record['index'] != tip.index + 1 + i for i, record in enumerate(records)): return None
+            if not self.validate_peer_chain([tip.to_dict()] + records): return None
+            with metrics.timer("chat_store_io_seconds", op="save"): self.store.append_many(records)
+            self.verified_index = len(self.chain) - 1
+            self.feed.publish(records[0]['index'])
+            return records
+
+    def broadcast_blocks(self, records: List[dict], origin_time: Optional[str] = None):
+        for record in records: self.gossip.remember(record['hash'])
+        headers = {"X-Origin-Time": origin_time or str(time.time())}
+        self.client.send("POST", self.gossip.relay_targets(self.peers), "/add_blocks", json=records, headers=headers)
+
+    def broadcast_block(self, block: Block, origin_time: Optional[str] = None):
+        # Relay to a random few peers; they relay on, and everyone drops repeats
+        self.gossip.remember(block.hash)
+        headers = {"X-Origin-Time": origin_time or str(time.time())}
+        self.client.send("POST", self.gossip.relay_targets(self.peers), "/add_block", json=block.to_dict(), headers=headers)
+
+    def peer_hash(self, peer: str, index: int) -> Optional[str]:
+        response = self.client.get(peer, f"/block_hash/{index}")
+        return response.json()['hash'] if response is not None and response.status_code == 200 else None
+
+    def find_common_ancestor(self, peer: str, peer_length: int) -> int:
+        # Equal hashes at an index mean equal chains up to it, so binary search
+        # for the last shared index; -1 when even the genesis blocks differ
+        low, high = -1, min(len(self.chain), peer_length) - 1
+        if high >= 0 and self.peer_hash(peer, high) == self.chain[high].hash: return high
+        high -= 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.peer_hash(peer, mid) == self.chain[mid].hash: low = mid
+            else: high = mid - 1
+        return low
 
     def resolve_conflicts(self) -> bool:
-        longest_chain = None
-        max_length = len(self.chain)
-
-        for peer in self.peers:
-            response = requests.get(f"http://{peer}/get_chain")
-            if response.status_code == 200:
-                peer_chain =  response.json()
-                if len(peer_chain) > max_length and self.validate_peer_chain(peer_chain):
-                    max_length = len(peer_chain)
-                    longest_chain = peer_chain
-        if longest_chain:
-            self.chain = [Block(**block) for block in longest_chain]
-            self.save_chain()
+        with metrics.timer("chat_resolve_conflicts_seconds"): return self.sync_longest_peer()
+
+    def sync_longest_peer(self) -> bool:
+        # Compare heights first, then fetch and check only the blocks after
+        # the last one we share with the longest peer
+        candidates = []
+        for peer, response in self.client.fan_out("GET", self.peers, "/height").items():
+            if response is not None and response.status_code == 200 and response.json()['length'] > len(self.chain):
+                candidates.append((response.json()['length'], peer))
+
+        for length, peer in sorted(candidates, reverse=True):
+            ancestor = self.find_common_ancestor(peer, length)
+            response = self.client.get(peer, "/get_chain", params={'from': ancestor + 1, 'format': 'binary'}, stream=True)
+            if response is None or response.status_code != 200: continue
+            # Peers that don't know format=binary answer with JSON
+            binary = response.headers.get('Content-Type') == 'application/octet-stream'
+            try: suffix = list((iter_frames if binary else iter_json_array)(response.iter_content(1 << 16)))
+            except ValueError: continue
+            if ancestor + 1 + len(suffix) <= len(self.chain): continue
+            if any(block['index'] != ancestor + 1 + i for i, block in enumerate(suffix)): continue
+            base = [self.chain[ancestor].to_dict()] if ancestor >= 0 else []
+            if not self.validate_peer_chain(base + suffix):
+                metrics.inc("chat_blocks_rejected_total", len(suffix), source="sync")
+                continue
+            with self.chain_lock:
+                # Our chain may have grown or moved while the suffix was fetched
+                if ancestor + 1 + len(suffix) <= len(self.chain): continue
+                if base and self.chain[ancestor].hash != base[0]['hash']: continue
+                self.replace_suffix(ancestor + 1, suffix)
+            metrics.inc("chat_blocks_accepted_total", len(suffix), source="sync")
             return True
         return False
 
-    def validate_peer_chain(self, peer_chain: list) -> bool:
-        temp_chain = []
-        for block_data in peer_chain:
-            block = Block(
-                    index=block_data['index'],
-                    timestamp=block_data['timestamp'],
-                    data=block_data['data'],
-                    previous_hash=block_data['previous_hash'],
-            )
-            if block.hash != block_data['hash']: return False
-            temp_chain.append(block)
-        for i in range(1, len(temp_chain)):
-            if temp_chain[i].previous_hash != temp_chain[i-1].hash: return False
+    def replace_suffix(self, start: int, records: list):
+        # Blocks before `start` stay where they are on disk
+        with self.chain_lock:
+            with metrics.timer("chat_store_io_seconds", op="replace"):
+                self.store.truncate(start)
+                self.store.append_many(records)
+            self.load_chain()
+            self.verified_index = len(self.chain) - 1
+            self.history.truncate(start)
+            self.feed.publish(start)
 
-        return True
+    def validate_peer_chain(self, peer_chain: Iterable[dict]) -> bool:
+        with metrics.timer("chat_chain_validation_seconds", chain="peer"):
+            return find_invalid_block(peer_chain, self.verify_workers) is None
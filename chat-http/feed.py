@@ -0,0 +1,34 @@
+import threading
+from collections import deque
+from typing import Optional, Tuple
+
+class BlockFeed:
+    """Wakes stream subscribers when the chain changes.
+
+    Every change bumps a sequence number and records the first block index
+    it touched: the new tip for appends, the fork point for a reorg.
+    Subscribers sleep on one shared condition, so idle ones cost a parked
+    thread and nothing per block; on waking they read what they missed
+    straight from the store.
+    """
+
+    def __init__(self, history: int = 1024):
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.changes = deque(maxlen=history)  # (seq, first changed index)
+
+    def publish(self, start: int):
+        with self.condition:
+            self.seq += 1
+            self.changes.append((self.seq, start))
+            self.condition.notify_all()
+
+    def wait(self, seq: int, timeout: Optional[float] = None) -> Tuple[int, Optional[int]]:
+        # Blocks until there are changes after `seq` or timeout passes.
+        # Returns the current seq and the lowest index changed since `seq`,
+        # 0 if that is too far back to tell, or None if nothing changed
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq != seq, timeout)
+            if self.seq == seq: return seq, None
+            if not self.changes or self.changes[0][0] > seq + 1: return self.seq, 0
+            return self.seq, min(start for change_seq, start in self.changes if change_seq > seq)
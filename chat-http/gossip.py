@@ -0,0 +1,61 @@
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Iterable, List, Optional
+
+class Gossip:
+    """Relay bookkeeping for blocks arriving from peers.
+
+    Remembers the last `capacity` block hashes so a block that comes back
+    through another peer is dropped before it is parsed or validated, and
+    picks `fanout` random peers to relay new blocks to. Counts duplicates
+    and keeps recent propagation latencies for stats().
+    """
+
+    def __init__(self, capacity: int = 10000, fanout: int = 4):
+        self.capacity = capacity
+        self.fanout = fanout
+        self.seen = OrderedDict()
+        self.received = 0
+        self.duplicates = 0
+        self.latencies = deque(maxlen=1000)
+        self.lock = threading.Lock()
+
+    def seen_before(self, block_hash: Optional[str]) -> bool:
+        with self.lock:
+            self.received += 1
+            if block_hash not in self.seen: return False
+            self.seen.move_to_end(block_hash)
+            self.duplicates += 1
+            return True
+
+    def remember(self, block_hash: str):
+        # Only called with hashes we computed, so a peer can't claim a hash
+        # for a bogus block and get the real one dropped later
+        with self.lock:
+            self.seen[block_hash] = None
+            if len(self.seen) > self.capacity: self.seen.popitem(last=False)
+
+    def relay_targets(self, peers: Iterable[str]) -> List[str]:
+        peers = list(peers)
+        return peers if len(peers) <= self.fanout else random.sample(peers, self.fanout)
+
+    def record_latency(self, origin_time: Optional[str]):
+        # origin_time is the X-Origin-Time header set by the node that made the block
+        try: latency = time.time() - float(origin_time)
+        except (TypeError, ValueError): return
+        with self.lock: self.latencies.append(latency)
+
+    def stats(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            received, duplicates = self.received, self.duplicates
+        percentile = lambda p: latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else None
+        return {
+            "received": received,
+            "duplicates": duplicates,
+            "duplicate_rate": duplicates / received if received else 0.0,
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+        }
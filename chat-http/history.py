@@ -0,0 +1,107 @@
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+TOKEN = re.compile(r"\w+")
+
+def tokens(text: str) -> set:
+    return set(TOKEN.findall(text.lower()))
+
+def block_messages(data: dict) -> list:
+    # Batched blocks hold a list of messages, older blocks a single one
+    return data["messages"] if "messages" in data else [data]
+
+def parse_time(timestamp) -> Optional[datetime]:
+    if isinstance(timestamp, datetime): return timestamp
+    try: return datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError): return None
+
+def time_bound(value) -> datetime:
+    # Block timestamps are naive local times, so bounds must be too
+    moment = parse_time(value)
+    if moment is None or moment.tzinfo is not None: raise ValueError(f"invalid time bound {value!r}")
+    return moment
+
+class HistoryIndex:
+    """Secondary indexes over the chat messages of a chain.
+
+    Every message after the genesis block gets an id in chain order and is
+    indexed by username, by block timestamp and by the lowercase words of
+    its text. Queries touch only the posting lists they filter on and fetch
+    just the messages they return. extend() indexes new blocks and
+    truncate() forgets blocks dropped by a reorg.
+    """
+
+    def __init__(self):
+        self.refs: List[Tuple[int, int]] = []  # message id -> (block index, position in block)
+        self.blocks = 0
+        self.by_user: Dict[str, List[int]] = defaultdict(list)
+        self.by_token: Dict[str, List[int]] = defaultdict(list)
+        # (timestamp, message id), sorted; messages with unreadable timestamps are left out
+        self.by_time: List[Tuple[datetime, int]] = []
+
+    def extend(self, blocks: Iterable):
+        for block in blocks:
+            self.blocks += 1
+            if block.index == 0: continue
+            moment = parse_time(block.timestamp)
+            for position, message in enumerate(block_messages(block.data)):
+                message_id = len(self.refs)
+                self.refs.append((block.index, position))
+                username = message.get("username") if isinstance(message, dict) else None
+                if isinstance(username, str): self.by_user[username].append(message_id)
+                text = message.get("message") if isinstance(message, dict) else None
+                if isinstance(text, str):
+                    for token in tokens(text): self.by_token[token].append(message_id)
+                # Blocks mostly arrive in time order, so this is nearly always an append
+                if moment is not None: insort(self.by_time, (moment, message_id))
+
+    def truncate(self, length: int):
+        # Drop everything from block `length` on; ids grow with the chain, so
+        # posting lists only lose their tails
+        if length >= self.blocks: return
+        cut = bisect_left(self.refs, (length, 0))
+        del self.refs[cut:]
+        for postings in (self.by_user, self.by_token):
+            for key in [key for key, ids in postings.items() if ids and ids[-1] >= cut]:
+                ids = postings[key]
+                del ids[bisect_left(ids, cut):]
+                if not ids: del postings[key]
+        self.by_time = [entry for entry in self.by_time if entry[1] < cut]
+        self.blocks = length
+
+    def search(self, user: Optional[str] = None, since=None, until=None, query: Optional[str] = None,
+               limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        """(block index, position) of the matching messages, oldest first.
+
+        since is inclusive and until exclusive; query matches messages that
+        contain all of its words. With a limit, the most recent matches are
+        returned.
+        """
+        if limit is not None and limit < 0: raise ValueError("limit must not be negative")
+        candidates = []
+        if user is not None: candidates.append(self.by_user.get(user, []))
+        if query is not None: candidates.extend(self.by_token.get(token, []) for token in tokens(query))
+        if since is not None or until is not None:
+            low = 0 if since is None else bisect_left(self.by_time, (time_bound(since), -1))
+            high = len(self.by_time) if until is None else bisect_left(self.by_time, (time_bound(until), -1))
+            candidates.append(sorted(message_id for _, message_id in self.by_time[low:high]))
+        if not candidates: ids = range(len(self.refs))
+        else:
+            # Walk the shortest list from the newest end, checking the others with bisect
+            candidates.sort(key=len)
+            shortest, others = candidates[0], candidates[1:]
+            ids = []
+            for message_id in reversed(shortest):
+                if all(contains(other, message_id) for other in others):
+                    ids.append(message_id)
+                    if limit is not None and len(ids) >= limit: break
+            ids.reverse()
+        if limit is not None: ids = ids[max(len(ids) - limit, 0):]
+        return [self.refs[message_id] for message_id in ids]
+
+def contains(ids: List[int], message_id: int) -> bool:
+    i = bisect_left(ids, message_id)
+    return i < len(ids) and ids[i] == message_id
@@ -0,0 +1,57 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import requests
+
+from metrics import metrics
+
+class PeerClient:
+    """HTTP calls to peers with one keep-alive session per peer.
+
+    Every call has a timeout and is retried with exponential backoff on
+    connection errors and 5xx answers. fan_out sends the same call to many
+    peers on a bounded thread pool, so it takes about as long as the
+    slowest peer; send queues it there and returns at once.
+    """
+
+    def __init__(self, timeout: float = 2.0, retries: int = 2, backoff: float = 0.1, max_workers: int = 16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def session(self, peer: str) -> requests.Session:
+        with self.lock:
+            if peer not in self.sessions: self.sessions[peer] = requests.Session()
+            return self.sessions[peer]
+
+    def request(self, method: str, peer: str, path: str, **kwargs) -> Optional[requests.Response]:
+        # The response, or None once every attempt failed
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.timer("chat_peer_request_seconds", peer=peer):
+                    response = self.session(peer).request(method, f"http://{peer}{path}", **kwargs)
+                if response.status_code < 500: return response
+            except requests.exceptions.RequestException: pass
+            if attempt < self.retries: time.sleep(self.backoff * 2 ** attempt)
+        metrics.inc("chat_peer_failures_total", peer=peer)
+        return None
+
+    def get(self, peer: str, path: str, **kwargs) -> Optional[requests.Response]:
+        return self.request("GET", peer, path, **kwargs)
+
+    def post(self, peer: str, path: str, **kwargs) -> Optional[requests.Response]:
+        return self.request("POST", peer, path, **kwargs)
+
+    def fan_out(self, method: str, peers: Iterable[str], path: str, **kwargs) -> Dict[str, Optional[requests.Response]]:
+        futures = {peer: self.pool.submit(self.request, method, peer, path, **kwargs) for peer in list(peers)}
+        return {peer: future.result() for peer, future in futures.items()}
+
+    def send(self, method: str, peers: Iterable[str], path: str, **kwargs):
+        # Like fan_out without waiting for the answers, e.g. for gossip relays
+        for peer in list(peers): self.pool.submit(self.request, method, peer, path, **kwargs)
@@ -0,0 +1,101 @@
+import codecs
+import json
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from codec import block_hash, is_batch
+from merkle import merkle_root
+
+CHUNK_SIZE = 2000
+
+def bad_merkle_root(data) -> bool:
+    # The block hash covers a batch's messages and its root as stored, so only
+    # recomputing the root shows whether the two agree
+    return is_batch(data) and merkle_root(data["messages"]) != data["merkle_root"]
+
+def first_bad_hash(chunk: List[dict]) -> Optional[int]:
+    # A block that can't be encoded (bad version, timestamp or hash) is bad too
+    for offset, record in enumerate(chunk):
+        try:
+            if block_hash(record) != record['hash'] or bad_merkle_root(record['data']): return offset
+        except (KeyError, TypeError, ValueError, struct.error): return offset
+    return None
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[dict]:
+    # Decode a JSON array one element at a time, e.g. from response.iter_content()
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    buffer, pos = "", 0
+    for chunk in chunks:
+        buffer = buffer[pos:] + decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n[,": pos += 1
+            if pos == len(buffer): break
+            if buffer[pos] == "]": return
+            try: value, pos_after = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError: break
+            yield value
+            pos = pos_after
+
+def _linked_chunks(records: Iterable[dict], chunk_size: int, bad_links: list) -> Iterator[Tuple[int, List[dict]]]:
+    # Links only need the stored hashes, so they are checked here in one list
+    # comparison per chunk while the hashing goes to the pool
+    records = iter(records)
+    previous_hash = None
+    position = 0
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk: return
+        links = [record['previous_hash'] for record in chunk]
+        expected = [links[0] if position == 0 else previous_hash]
+        expected.extend(record['hash'] for record in chunk[:-1])
+        if links != expected:
+            bad_links.append(position + next(i for i, (a, b) in enumerate(zip(links, expected)) if a != b))
+            yield position, chunk
+            return
+        yield position, chunk
+        previous_hash = chunk[-1]['hash']
+        position += len(chunk)
+
+def _pooled(chunks: Iterator[Tuple[int, List[dict]]], workers: int) -> Iterator[Tuple[int, Optional[int]]]:
+    pool = ProcessPoolExecutor(workers)
+    in_flight = deque()
+    try:
+        for position, chunk in chunks:
+            in_flight.append((position, pool.submit(first_bad_hash, chunk)))
+            if len(in_flight) > 2 * workers:
+                position, future = in_flight.popleft()
+                yield position, future.result()
+        while in_flight:
+            position, future = in_flight.popleft()
+            yield position, future.result()
+    finally: pool.shutdown(cancel_futures=True)
+
+def find_invalid_block(records: Iterable[dict], workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE) -> Optional[int]:
+    """Return the position of the first block with a wrong hash or link, or None.
+
+    records can be any iterable of block dicts (a list, a generator over the
+    stored chain, iter_json_array over an HTTP body); at most a few chunks are
+    held at once.
+    """
+    workers = workers or os.cpu_count()
+    bad_links = []
+    chunks = _linked_chunks(records, chunk_size, bad_links)
+    head = list(islice(chunks, 2))
+    if workers == 1 or len(head) < 2:
+        results = ((position, first_bad_hash(chunk)) for position, chunk in chain(head, chunks))
+    else: results = _pooled(chain(head, chunks), workers)
+
+    bad_hash = None
+    for position, offset in results:
+        if offset is not None:
+            bad_hash = position + offset
+            break
+    results.close()
+    bad = [index for index in (bad_hash, *bad_links) if index is not None]
+    return min(bad) if bad else None
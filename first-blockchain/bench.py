@@ -0,0 +1,133 @@
+import hashlib
+import json
+import platform
+import time
+from argparse import ArgumentParser
+
+from blockchain import Block, Blockchain
+from codec import NONCE, encode_header
+from mining import INITIAL_DIFFICULTY, difficulty_target
+
+def header_parts(fields):
+    """Split the sort_keys JSON of a block around its nonce.
+
+    json.dumps(dict(fields, nonce=n), sort_keys=True) == prefix + str(n) + suffix,
+    so the prefix can be hashed once and only the nonce and suffix per attempt.
+    """
+    items = sorted(fields.items())
+    prefix = '{' + ''.join(
+        f'{json.dumps(key)}: {json.dumps(value, sort_keys=True)}, '
+        for key, value in items if key < 'nonce'
+    ) + '"nonce": '
+    suffix = ''.join(
+        f', {json.dumps(key)}: {json.dumps(value, sort_keys=True)}'
+        for key, value in items if key > 'nonce'
+    ) + '}'
+    return prefix.encode(), suffix.encode()
+
+def legacy_attempts(fields, attempts):
+    for nonce in range(attempts):
+        block_string = json.dumps(dict(fields, nonce=nonce), sort_keys=True).encode()
+        hashlib.sha256(block_string).hexdigest().startswith('0' * 64)
+
+def midstate_attempts(fields, attempts):
+    prefix, suffix = header_parts(fields)
+    midstate = hashlib.sha256(prefix)
+    target = difficulty_target(256)
+    for nonce in range(attempts):
+        attempt = midstate.copy()
+        attempt.update(b'%d%s' % (nonce, suffix))
+        attempt.digest() <= target
+
+def binary_attempts(fields, attempts):
+    midstate = hashlib.sha256(encode_header(fields))
+    target = difficulty_target(256)
+    for nonce in range(attempts):
+        attempt = midstate.copy()
+        attempt.update(NONCE.pack(nonce))
+        attempt.digest() <= target
+
+def hashes_per_sec(search, fields, attempts):
+    start = time.perf_counter()
+    search(fields, attempts)
+    return attempts / (time.perf_counter() - start)
+
+def bench_mine_block(blocks, difficulty):
+    # Serial mining from nonce 0, so each block took nonce + 1 attempts
+    attempts = 0
+    start = time.perf_counter()
+    for index in range(1, blocks + 1):
+        block = Block(index, "0" * 64, [], time.time(), difficulty=difficulty)
+        block.mine_block()
+        attempts += block.nonce + 1
+    elapsed = time.perf_counter() - start
+    return {"difficulty": difficulty, "blocks": blocks, "attempts": attempts, "hashes_per_sec": attempts / elapsed}
+
+def build_chain(blockchain, size):
+    # Blocks 1000s apart, so retargeting soon settles on the lowest
+    # difficulty and the chain is cheap to mine. The genesis block is
+    # backdated so the last one is not in the future
+    genesis_time = time.time() - 1000 * size
+    genesis = Block(0, "0" * 64, "Genesis Block", genesis_time)
+    genesis.mine_block()
+    chain = [genesis]
+    transactions = [{"sender": "Alice", "receiver": "Bob", "amount": 1}]
+    while len(chain) < size:
+        index = len(chain)
+        block = Block(index, chain[-1].hash, transactions, genesis_time + 1000 * index,
+                      difficulty=blockchain.expected_difficulty(chain, index))
+        block.mine_block()
+        chain.append(block)
+    return chain
+
+def bench_is_chain_valid(blockchain, chain, sizes):
+    results = {}
+    for size in sizes:
+        start = time.perf_counter()
+        if not blockchain.is_chain_valid(chain[:size]):
+            raise RuntimeError(f"generated chain of {size} blocks is invalid")
+        elapsed = time.perf_counter() - start
+        results[str(size)] = {"seconds": elapsed, "blocks_per_sec": size / elapsed}
+    return results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--attempts', default=200000, type=int)
+    parser.add_argument('-b', '--blocks', default=20, type=int, help="Blocks to mine for the mine_block rate")
+    parser.add_argument('-s', '--sizes', nargs='*', default=[1000, 10000], type=int, help="Chain lengths to validate")
+    parser.add_argument('-o', '--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    fields = {
+        "index": 1,
+        "previous_hash": "0" * 64,
+        "merkle_root": "ab" * 32,
+        "timestamp": time.time(),
+        "difficulty": 16,
+    }
+    for nonce in (0, 7, 123456789):
+        prefix, suffix = header_parts(fields)
+        assert prefix + str(nonce).encode() + suffix == json.dumps(dict(fields, nonce=nonce), sort_keys=True).encode()
+
+    before = hashes_per_sec(legacy_attempts, fields, args.attempts)
+    midstate = hashes_per_sec(midstate_attempts, fields, args.attempts)
+    binary = hashes_per_sec(binary_attempts, fields, args.attempts)
+    print(f"json.dumps per attempt: {before:,.0f} H/s")
+    print(f"JSON midstate + digest: {midstate:,.0f} H/s ({midstate / before:.1f}x)")
+    print(f"binary header midstate: {binary:,.0f} H/s ({binary / before:.1f}x)")
+
+    mined = bench_mine_block(args.blocks, INITIAL_DIFFICULTY)
+    print(f"mine_block at {mined['difficulty']} bits: {mined['hashes_per_sec']:,.0f} H/s")
+    blockchain = Blockchain(workers=1)
+    validated = bench_is_chain_valid(blockchain, build_chain(blockchain, max(args.sizes)), args.sizes)
+    for size, result in validated.items():
+        print(f"is_chain_valid, {size} blocks: {result['seconds']:.3f}s ({result['blocks_per_sec']:,.0f} blocks/s)")
+
+    if args.output:
+        results = {
+            "header_hash": {"json": before, "json_midstate": midstate, "binary_midstate": binary},
+            "mine_block": mined,
+            "is_chain_valid": validated,
+        }
+        with open(args.output, 'w') as f:
+            json.dump({"suite": "first-blockchain", "python": platform.python_version(), "results": results}, f, indent=2)
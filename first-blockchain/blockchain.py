@@ -1,45 +1,97 @@
-import hashlib
+import os
 import time
-import json
+
+from codec import VERSION, header_hash
+from merkle import merkle_proof, merkle_root, verify_proof
+from mining import (INITIAL_DIFFICULTY, MAX_FUTURE, RETARGET_WINDOW, TARGET_INTERVAL, difficulty_target, median_time, parallel_mine,
+                    retarget, serial_mine)
+
+# Every SNAPSHOT_INTERVAL-th block keeps a copy of the balances after it
+SNAPSHOT_INTERVAL = 100
+
+def chain_work(blocks):
+    # Expected hashes behind the blocks; chains are compared by this, not length
+    return sum(2 ** block.difficulty for block in blocks)
 
 class Block:
-    def __init__(self, index, previous_hash, data, timestamp, nonce=0):
+    # The hash is kept as its 32 raw bytes; .hash gives the hex string
+    __slots__ = ("index", "previous_hash", "data", "timestamp", "nonce", "difficulty", "version", "merkle_root", "digest")
+
+    def __init__(self, index, previous_hash, data, timestamp, nonce=0, difficulty=INITIAL_DIFFICULTY, version=VERSION):
+        self.version = version
         self.index = index
         self.previous_hash = previous_hash
         self.data = data
         self.timestamp = timestamp
         self.nonce = nonce
+        self.difficulty = difficulty
+        self.merkle_root = merkle_root(self.transactions())
         self.hash = self.calculate_hash()
+
+    @property
+    def hash(self):
+        return self.digest.hex()
+
+    @hash.setter
+    def hash(self, value):
+        self.digest = bytes.fromhex(value)
+
+    def transactions(self):
+        # The genesis block carries a plain string instead of a list
+        return self.data if isinstance(self.data, list) else [self.data]
+
     def calculate_hash(self):
-        block_string = json.dumps({
+        # The header commits to the transactions through merkle_root, so a
+        # single transaction can be proven without the rest of the block.
+        # Version 0 blocks are still checked against their JSON hash
+        return header_hash(self.header_fields(), self.nonce, self.version)
+
+    def header_fields(self):
+        return {
             "index": self.index,
             "previous_hash": self.previous_hash,
-            "data": self.data,
+            "merkle_root": self.merkle_root,
             "timestamp": self.timestamp,
-            "nonce": self.nonce
-        }, sort_keys=True).encode()
-        print(block_string)
-        return hashlib.sha256(block_string).hexdigest()
+            "difficulty": self.difficulty,
+        }
 
-    def mine_block(self, difficulty):
-        while not self.hash.startswith('0' * difficulty):
-            self.nonce += 1
-            self.hash = self.calculate_hash()
+    def mine_block(self, workers=1, tracer=None):
+        if self.version != VERSION: raise ValueError("only current-version blocks can be mined")
+        if tracer: tracer.start(self.index, self.nonce)
+        if workers > 1:
+            self.nonce, self.digest = parallel_mine(self.header_fields(), self.difficulty, self.nonce, workers)
+        else:
+            self.nonce, self.digest = serial_mine(self.header_fields(), self.difficulty, self.nonce, tracer)
+        if tracer: tracer.solved(self.nonce)
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, workers=None, tracer=None, target_interval=TARGET_INTERVAL):
         self.chain = []
-        self.difficulty = 4
+        self.target_interval = target_interval
+        self.workers = workers or os.cpu_count()
+        self.tracer = tracer
         self.balances = {
                 'Alice': 1000,
                 'Bob': 500,
         }
+        self.snapshots = {}
         self.create_genesis_block()
 
+    @property
+    def difficulty(self):
+        # Leading zero bits the next block needs
+        return self.expected_difficulty(self.chain, len(self.chain))
+
+    def expected_difficulty(self, chain, index):
+        # Retargeted from the timestamps of the RETARGET_WINDOW + 1 blocks before `index`
+        window = chain[max(0, index - RETARGET_WINDOW - 1):index]
+        return retarget([block.timestamp for block in window], [block.difficulty for block in window], self.target_interval)
+
     def create_genesis_block(self):
-        genesis = Block(0, "0", "Genesis Block", time.time())
-        genesis.mine_block(self.difficulty)
+        genesis = Block(0, "0" * 64, "Genesis Block", time.time(), difficulty=self.difficulty)
+        genesis.mine_block(self.workers, self.tracer)
         self.chain.append(genesis)
+        self.snapshots[0] = self.balances.copy()
 
     def add_block(self, transactions):
         if not self.validate_transactions(transactions):
@@ -51,15 +103,18 @@ class Blockchain:
             index=len(self.chain),
             previous_hash=last_block.hash,
             data=transactions,
-            timestamp=time.time()
+            timestamp=time.time(),
+            difficulty=self.difficulty
         )
-        new_block.mine_block(self.difficulty)
+        new_block.mine_block(self.workers, self.tracer)
         self.execute_transactions(transactions)
         self.chain.append(new_block)
+        if new_block.index % SNAPSHOT_INTERVAL == 0:
+            self.snapshots[new_block.index] = self.balances.copy()
         return True
 
-    def validate_transactions(self, transactions):
-        temp_balances = self.balances.copy()
+    def validate_transactions(self, transactions, balances=None):
+        temp_balances = (self.balances if balances is None else balances).copy()
         for tx in transactions:
             if tx['amount'] <= 0:
                 return False
@@ -69,22 +124,95 @@ class Blockchain:
             temp_balances[tx['receiver']] = temp_balances.get(tx['receiver'], 0) + tx['amount']
         return True
     
-    def execute_transactions(self, transactions):
+    def execute_transactions(self, transactions, balances=None):
+        if balances is None: balances = self.balances
         for tx in transactions:
-            self.balances[tx['sender']] -= tx['amount']
-            self.balances[tx['receiver']] = self.balances.get(tx['receiver'], 0) + tx['amount']
+            balances[tx['sender']] -= tx['amount']
+            balances[tx['receiver']] = balances.get(tx['receiver'], 0) + tx['amount']
 
-    def is_chain_valid(self):
-        for i in range(1, len(self.chain)):
-            current = self.chain[i]
-            previous = self.chain[i-1]
+    def restore_snapshot(self, index):
+        # Balances right after block `index`: the nearest snapshot at or
+        # before it plus the blocks in between
+        base = index - index % SNAPSHOT_INTERVAL
+        balances = self.snapshots[base].copy()
+        for block in self.chain[base + 1:index + 1]:
+            self.execute_transactions(block.data, balances)
+        return balances
 
+    def balance_at(self, account, index):
+        return self.restore_snapshot(index).get(account, 0)
+
+    def find_fork(self, chain):
+        # First index where `chain` differs from ours, found by bisection. The
+        # peer's blocks before it are never used, so a prefix that only
+        # matches ours in places cannot slip in
+        low, high = 1, min(len(self.chain), len(chain))
+        while low < high:
+            middle = (low + high) // 2
+            if chain[middle].digest == self.chain[middle].digest: low = middle + 1
+            else: high = middle
+        return low
+
+    def replace_chain(self, chain):
+        # Adopt a valid chain with more work that shares our genesis block.
+        # Only the blocks after the fork are compared and validated, against
+        # our shared prefix, and balances roll back to the nearest snapshot
+        # before the fork, so the cost follows the fork depth
+        if not chain or chain[0].hash != self.chain[0].hash:
+            return False
+        fork = self.find_fork(chain)
+        if chain_work(chain[fork:]) <= chain_work(self.chain[fork:]):
+            return False
+        # The retarget window of the first new block reaches back before the fork
+        start = max(fork - RETARGET_WINDOW - 1, 0)
+        if not self.is_chain_valid(self.chain[start:fork] + chain[fork:], fork - start):
+            return False
+        balances = self.restore_snapshot(fork - 1)
+        snapshots = {index: snapshot for index, snapshot in self.snapshots.items() if index < fork}
+        for block in chain[fork:]:
+            if not self.validate_transactions(block.data, balances):
+                return False
+            self.execute_transactions(block.data, balances)
+            if block.index % SNAPSHOT_INTERVAL == 0: snapshots[block.index] = balances.copy()
+        self.chain = self.chain[:fork] + chain[fork:]
+        self.balances = balances
+        self.snapshots = snapshots
+        return True
+
+    def is_chain_valid(self, chain=None, start=1):
+        # Blocks from position `start` on are checked; those before it are
+        # trusted and only serve as links and retarget history
+        if chain is None: chain = self.chain
+        for i in range(max(start, 1), len(chain)):
+            current = chain[i]
+            previous = chain[i-1]
+
+            if current.merkle_root != merkle_root(current.transactions()):
+                return False
             if current.hash != current.calculate_hash():
                 return False
             if current.previous_hash != previous.hash:
                 return False
+            window = chain[max(0, i - RETARGET_WINDOW - 1):i]
+            if current.timestamp <= median_time([block.timestamp for block in window]):
+                return False
+            if current.timestamp > time.time() + MAX_FUTURE:
+                return False
+            if current.difficulty != self.expected_difficulty(chain, i):
+                return False
+            if current.digest > difficulty_target(current.difficulty):
+                return False
         return True
 
+    def transaction_proof(self, index, position):
+        block = self.chain[index]
+        return {
+            "transaction": block.transactions()[position],
+            "proof": merkle_proof(block.transactions(), position),
+            "merkle_root": block.merkle_root,
+            "header": dict(block.header_fields(), nonce=block.nonce, version=block.version, hash=block.hash),
+        }
+
     def print_chain(self):
         for block in self.chain:
             print(f"\nBlock {block.index}:")
@@ -92,6 +220,7 @@ class Blockchain:
             print(f"Previous Hash: {block.previous_hash}")
             print(f"Timestamp: {block.timestamp}")
             print(f"Nonce: {block.nonce}")
+            print(f"Difficulty: {block.difficulty} bits")
             print("Transactions:")
             if isinstance(block.data, list):
                 for tx in block.data: print(f"  {tx['sender']} -> {tx['receiver']}: {tx['amount']}")
@@ -126,6 +255,10 @@ if __name__ == "__main__":
     print("Bob:", blockchain.balances['Bob'])
 
     print("\nBlockchain valid?", blockchain.is_chain_valid())
+    print("Alice after block 0:", blockchain.balance_at("Alice", 0))
+
+    proof = blockchain.transaction_proof(1, 1)
+    print("Transaction proven by Merkle proof?", verify_proof(proof["transaction"], proof["proof"], proof["merkle_root"]))
 
     print("\nBlockchain structure:")
     blockchain.print_chain()
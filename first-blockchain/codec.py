@@ -0,0 +1,30 @@
+import hashlib
+import json
+import struct
+
+# Blocks of version 1 are hashed over this fixed binary header followed by
+# the nonce; version 0 blocks over the sort_keys JSON of the same fields
+VERSION = 1
+# version, index, previous hash, merkle root, timestamp, difficulty
+HEADER = struct.Struct('>BQ32s32sdH')
+NONCE = struct.Struct('>Q')
+
+def encode_header(fields):
+    # Everything the hash covers except the nonce, so miners hash it once
+    return HEADER.pack(
+        VERSION,
+        fields["index"],
+        bytes.fromhex(fields["previous_hash"]),
+        bytes.fromhex(fields["merkle_root"]),
+        fields["timestamp"],
+        fields["difficulty"],
+    )
+
+def legacy_hash(fields, nonce):
+    block_string = json.dumps(dict(fields, nonce=nonce), sort_keys=True).encode()
+    return hashlib.sha256(block_string).hexdigest()
+
+def header_hash(fields, nonce, version=VERSION):
+    if version == 0: return legacy_hash(fields, nonce)
+    if version == VERSION: return hashlib.sha256(encode_header(fields) + NONCE.pack(nonce)).hexdigest()
+    raise ValueError(f"unknown block version {version}")
@@ -0,0 +1,139 @@
+import hashlib
+import itertools
+import math
+import os
+import time
+from multiprocessing import Pool, Value
+
+from codec import NONCE, encode_header
+
+CHUNK_SIZE = 20000
+CHUNKS_PER_WORKER = 4
+
+# Difficulty is a number of leading zero bits; 16 is the old four hex zeros
+INITIAL_DIFFICULTY = 16
+MIN_DIFFICULTY = 8
+MAX_DIFFICULTY = 256
+TARGET_INTERVAL = 2.0
+RETARGET_WINDOW = 10
+MAX_STEP = 1
+# Retargeting trusts block timestamps, so each must be later than the median
+# of the RETARGET_WINDOW + 1 before it and at most MAX_FUTURE seconds ahead
+# of the local clock
+MAX_FUTURE = 60.0
+
+_found = None
+
+def difficulty_target(difficulty):
+    # A digest with `difficulty` leading zero bits is at most this value
+    return ((1 << 256 - difficulty) - 1).to_bytes(32, 'big')
+
+def median_time(timestamps):
+    ordered = sorted(timestamps)
+    return ordered[len(ordered) // 2]
+
+def retarget(timestamps, difficulties, target_interval=TARGET_INTERVAL):
+    """Difficulty of the block that follows a window of recent blocks.
+
+    The work done over the window (2 ** difficulty per block) divided by the
+    time it took estimates the hash rate. The result is the difficulty that
+    takes about target_interval seconds at that rate, at most MAX_STEP bits
+    away from the last block's.
+    """
+    if len(timestamps) < 2: return INITIAL_DIFFICULTY
+    span = max(timestamps[-1] - timestamps[0], 1e-6)
+    work = sum(2 ** difficulty for difficulty in difficulties[1:])
+    ideal = round(math.log2(work / span * target_interval))
+    last = difficulties[-1]
+    ideal = max(last - MAX_STEP, min(last + MAX_STEP, ideal))
+    return max(MIN_DIFFICULTY, min(MAX_DIFFICULTY, ideal))
+
+def search_nonces(fields, difficulty, nonces, checkpoint=None, every=1024):
+    # checkpoint(nonce) runs every `every` attempts; returning True stops the search.
+    # The binary header is hashed once and only the nonce per attempt
+    midstate = hashlib.sha256(encode_header(fields))
+    target = difficulty_target(difficulty)
+    pack = NONCE.pack
+    for nonce in nonces:
+        if checkpoint and nonce % every == 0 and checkpoint(nonce): return None
+        attempt = midstate.copy()
+        attempt.update(pack(nonce))
+        digest = attempt.digest()
+        if digest <= target: return nonce, digest
+    return None
+
+def serial_mine(fields, difficulty, start_nonce=0, tracer=None):
+    nonces = itertools.count(start_nonce)
+    if tracer: return search_nonces(fields, difficulty, nonces, tracer.sample, tracer.sample_every)
+    return search_nonces(fields, difficulty, nonces)
+
+class HashTracer:
+    """Opt-in mining instrumentation.
+
+    callback gets a dict with the block index, attempts, hashes_per_sec and
+    elapsed seconds every sample_every attempts, and once more with
+    "solved": True when the nonce is found. Parallel mining only reports
+    the solution, since attempts happen in the worker processes.
+    """
+    def __init__(self, callback=print, sample_every=100000):
+        self.callback = callback
+        self.sample_every = sample_every
+        self.index = None
+        self.start_nonce = 0
+        self.started = 0.0
+
+    def start(self, index, start_nonce):
+        self.index = index
+        self.start_nonce = start_nonce
+        self.started = time.perf_counter()
+
+    def sample(self, nonce):
+        if nonce != self.start_nonce: self.callback(self._report(nonce, False))
+        return False
+
+    def solved(self, nonce):
+        self.callback(self._report(nonce + 1, True))
+
+    def _report(self, nonce, solved):
+        elapsed = time.perf_counter() - self.started
+        attempts = nonce - self.start_nonce
+        return {
+            "index": self.index,
+            "attempts": attempts,
+            "hashes_per_sec": attempts / elapsed if elapsed else 0.0,
+            "elapsed": elapsed,
+            "solved": solved,
+        }
+
+def _init_worker(found):
+    global _found
+    _found = found
+
+def _search_chunk(args):
+    fields, difficulty, start, count = args
+    # Another worker already solved below this chunk, nothing here can win
+    cancelled = lambda nonce: 0 <= _found.value < start
+    result = search_nonces(fields, difficulty, range(start, start + count), cancelled)
+    if result:
+        with _found.get_lock():
+            if _found.value < 0 or result[0] < _found.value: _found.value = result[0]
+    return result
+
+def parallel_mine(fields, difficulty, start_nonce=0, workers=None, chunk_size=CHUNK_SIZE):
+    """Search nonces from start_nonce across a process pool.
+
+    Chunks are handed out in rounds and results read back in order, so the
+    returned (nonce, digest) is the lowest solution, same as the serial loop.
+    """
+    workers = workers or os.cpu_count()
+    found = Value('q', -1)
+    start = start_nonce
+    with Pool(workers, initializer=_init_worker, initargs=(found,)) as pool:
+        while True:
+            round_chunks = [
+                (fields, difficulty, start + i * chunk_size, chunk_size)
+                for i in range(workers * CHUNKS_PER_WORKER)
+            ]
+            for result in pool.imap(_search_chunk, round_chunks):
+                if result: return result
+            start += len(round_chunks) * chunk_size
@@ -1,99 +1,242 @@
-import hashlib
 import json
+import threading
+import time
 from datetime import datetime
-from flask import Flask, jsonify, request
-import requests
+from flask import Flask, Response, g, jsonify, request
+
+from codec import VERSION, encode_frame, iter_frames
+from columns import ChainColumns
+from merkle import merkle_proof, merkle_root
+from metrics import metrics
+from miner import Miner
+from peers import PeerClient
+from verify import INITIAL_BITS, RETARGET_WINDOW, block_hash, expected_bits, find_invalid_block, search_proofs, valid_proof
 
 app = Flask(__name__)
 
+# Every SNAPSHOT_INTERVAL-th block keeps a copy of the balances after it
+SNAPSHOT_INTERVAL = 100
+
 class Blockchain:
     def __init__(self):
-        self.chain = []
+        self.chain = ChainColumns()
         self.pending_transactions = []
+        self.pending_deltas = {}
         self.balances = {}
+        self.snapshots = {}
+        self.lock = threading.RLock()
         self.nodes = set()
-        self.create_block(proof=1, previous_hash='0')  # Genesis block
-
-    def create_block(self, proof, previous_hash):
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': str(datetime.now()),
-            'transactions': self.pending_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash,
-        }
-        block['hash'] = self.hash(block)
-        self.pending_transactions = []
+        self.client = PeerClient()
+        self.verify_workers = None
+        self.miner = Miner(self)
+        self.create_block(proof=1, previous_hash='0' * 64)  # Genesis block
+
+    def create_block(self, proof, previous_hash, bits=INITIAL_BITS):
+        with self.lock:
+            block = {
+                'version': VERSION,
+                'index': len(self.chain) + 1,
+                'timestamp': str(datetime.now()),
+                'transactions': self.pending_transactions,
+                'merkle_root': merkle_root(self.pending_transactions),
+                'proof': proof,
+                'bits': bits,
+                'previous_hash': previous_hash,
+            }
+            block['hash'] = self.hash(block)
+            self.pending_transactions = []
+            self.pending_deltas = {}
+            self.append_block(block)
+            metrics.inc('wallet_blocks_accepted_total', source='local')
+            return block
+
+    def append_block(self, block):
         self.chain.append(block)
         self.process_transactions(block['transactions'])
-        return block
+        position = len(self.chain) - 1
+        if position % SNAPSHOT_INTERVAL == 0:
+            self.snapshots[position] = dict(self.balances)
 
-    def process_transactions(self, transactions):
+    def restore_snapshot(self, position):
+        # Balances as they were right after the block at `position`: the
+        # nearest snapshot at or before it plus the blocks in between
+        base = position - position % SNAPSHOT_INTERVAL
+        balances = dict(self.snapshots[base])
+        for block in self.chain[base + 1:position + 1]:
+            self.process_transactions(block['transactions'], balances)
+        return balances
+
+    def balance_at(self, user_id, position):
+        with self.lock:
+            return self.restore_snapshot(position).get(user_id, 0)
+
+    def process_transactions(self, transactions, balances=None):
+        if balances is None:
+            balances = self.balances
         for tx in transactions:
             user_id = tx['user_id']
             amount = tx['amount']
             if tx['type'] == 'add':
-                self.balances[user_id] = self.balances.get(user_id, 0) + amount
+                balances[user_id] = balances.get(user_id, 0) + amount
             elif tx['type'] == 'withdraw':
-                self.balances[user_id] = self.balances.get(user_id, 0) - amount
+                balances[user_id] = balances.get(user_id, 0) - amount
 
     def add_transaction(self, user_id, amount, tx_type):
-        self.pending_transactions.append({
-            'user_id': user_id,
-            'amount': amount,
-            'type': tx_type,
-            'timestamp': str(datetime.now())
-        })
+        with self.lock:
+            self.pending_transactions.append({
+                'user_id': user_id,
+                'amount': amount,
+                'type': tx_type,
+                'timestamp': str(datetime.now())
+            })
+            delta = amount if tx_type == 'add' else -amount
+            self.pending_deltas[user_id] = self.pending_deltas.get(user_id, 0) + delta
+
+    def available_balance(self, user_id):
+        # Confirmed balance plus what the mempool adds or takes away
+        with self.lock:
+            return self.balances.get(user_id, 0) + self.pending_deltas.get(user_id, 0)
+
+    def withdraw(self, user_id, amount):
+        # Check and queue under one lock so concurrent withdrawals can't
+        # both spend the same funds
+        with self.lock:
+            if self.available_balance(user_id) < amount:
+                return False
+            self.add_transaction(user_id, amount, 'withdraw')
+            return True
 
     @staticmethod
     def hash(block):
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        return block_hash(block)
+
+    def next_bits(self):
+        # Difficulty the next block must be mined at
+        with self.lock:
+            return expected_bits(self.chain[-RETARGET_WINDOW - 1:])
 
-    def proof_of_work(self, last_proof):
-        proof = 0
-        while not self.valid_proof(last_proof, proof):
-            proof += 1
-        return proof
+    def proof_of_work(self, last_proof, bits=INITIAL_BITS):
+        return search_proofs(last_proof, 0, 1 << 64, bits)
 
     @staticmethod
-    def valid_proof(last_proof, proof):
-        guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash.startswith('0000')
-
-    def valid_chain(self, chain):
-        previous_block = chain[0]
-        for block in chain[1:]:
-            if block['previous_hash'] != self.hash(previous_block):
-                return False
-            if not self.valid_proof(previous_block['proof'], block['proof']):
-                return False
-            previous_block = block
-        return True
+    def valid_proof(last_proof, proof, bits=INITIAL_BITS):
+        return valid_proof(last_proof, proof, bits)
+
+    def valid_chain(self, chain, start=0):
+        # start is the position of chain[0] when it is only part of a chain
+        with metrics.timer('wallet_chain_validation_seconds'):
+            return find_invalid_block(chain, self.verify_workers, start=start) is None
+
+    def peer_hash(self, node, position):
+        response = self.client.get(node, f'/block_hash/{position}')
+        if response is None or response.status_code != 200:
+            return None
+        return response.json()['hash']
+
+    def find_common_ancestor(self, node, peer_length):
+        # Equal hashes at a position mean equal chains up to it, so binary
+        # search for the last shared position; -1 when the genesis blocks differ
+        low, high = -1, min(len(self.chain), peer_length) - 1
+        if high >= 0 and self.peer_hash(node, high) == self.chain[high]['hash']:
+            return high
+        high -= 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.peer_hash(node, mid) == self.chain[mid]['hash']:
+                low = mid
+            else:
+                high = mid - 1
+        return low
 
     def resolve_conflicts(self):
-        longest_chain = None
-        max_length = len(self.chain)
-        for node in self.nodes:
-            response = requests.get(f'http://{node}/chain')
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    longest_chain = chain
-        if longest_chain:
-            self.chain = longest_chain
-            self.balances = {}
-            for block in self.chain:
-                self.process_transactions(block['transactions'])
+        with metrics.timer('wallet_resolve_conflicts_seconds'):
+            return self.sync_longest_node()
+
+    def sync_longest_node(self):
+        # Compare heights first, then fetch and check only the blocks after
+        # the last one we share with the longest peer
+        candidates = []
+        with self.lock:
+            nodes = list(self.nodes)
+        for node, response in self.client.fan_out('GET', nodes, '/height').items():
+            if response is not None and response.status_code == 200 and response.json()['length'] > len(self.chain):
+                candidates.append((response.json()['length'], node))
+
+        for length, node in sorted(candidates, reverse=True):
+            ancestor = self.find_common_ancestor(node, length)
+            response = self.client.get(node, '/chain', params={'from': ancestor + 1, 'format': 'binary'}, stream=True)
+            if response is None or response.status_code != 200:
+                continue
+            # Peers that don't know format=binary answer with JSON
+            try:
+                if response.headers.get('Content-Type') == 'application/octet-stream':
+                    suffix = list(iter_frames(response.iter_content(1 << 16)))
+                else:
+                    suffix = response.json()['chain']
+            except ValueError:
+                continue
+            if ancestor + 1 + len(suffix) <= len(self.chain):
+                continue
+            # The blocks before the suffix cover its first blocks' retarget window
+            start = max(ancestor - RETARGET_WINDOW, 0)
+            base = self.chain[start:ancestor + 1]
+            if not self.valid_chain(base + suffix, start):
+                metrics.inc('wallet_blocks_rejected_total', len(suffix), source='sync')
+                continue
+            with self.lock:
+                # Our chain may have grown or moved while the suffix was fetched
+                if ancestor + 1 + len(suffix) <= len(self.chain):
+                    continue
+                if base and self.chain[ancestor]['hash'] != base[-1]['hash']:
+                    continue
+                self.replace_suffix(ancestor + 1, suffix)
+                # Blocks mined on the old tip would be orphaned
+                self.miner.cancel()
+            metrics.inc('wallet_blocks_accepted_total', len(suffix), source='sync')
             return True
         return False
 
+    def replace_suffix(self, start, blocks):
+        # Roll back to the nearest snapshot before the fork and replay only
+        # from there instead of from genesis
+        with self.lock:
+            self.balances = self.restore_snapshot(start - 1) if start else {}
+            self.snapshots = {position: balances for position, balances in self.snapshots.items() if position < start}
+            self.chain.truncate(start)
+            for block in blocks:
+                self.append_block(block)
+
 blockchain = Blockchain()
 users = {}
 current_user_id = 0
+# Guards users and current_user_id; chain and balance state is guarded by blockchain.lock
+users_lock = threading.Lock()
+
+metrics.gauge('wallet_chain_length', lambda: len(blockchain.chain))
+metrics.gauge('wallet_mempool_transactions', lambda: len(blockchain.pending_transactions))
+metrics.gauge('wallet_nodes', lambda: len(blockchain.nodes))
+metrics.gauge('wallet_users', lambda: len(users))
+
+@app.before_request
+def start_timer():
+    if metrics.enabled:
+        g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # Labelled by route pattern, not path, so /mine/<job_id> is one series.
+    # Streamed bodies are timed up to their first byte
+    if metrics.enabled and request.url_rule is not None and 'started' in g:
+        route = request.url_rule.rule
+        metrics.observe('wallet_http_request_seconds', time.perf_counter() - g.started, route=route, method=request.method)
+        metrics.inc('wallet_http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.enabled:
+        return jsonify({'message': 'Metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4'), 200
 
 
 
@@ -104,15 +247,18 @@ current_user_id = 0
 @app.route('/users', methods=['POST'])
 def register_user():
     global current_user_id
-    current_user_id += 1
-    user_id = current_user_id
-    users[user_id] = {'id': user_id}
+    with users_lock:
+        current_user_id += 1
+        user_id = current_user_id
+        users[user_id] = {'id': user_id}
     return jsonify({'user_id': user_id}), 201
 
 @app.route('/users/list', methods=['POST'])
 def print_users():
     print("Hi")
-    return jsonify({'users': users}), 200
+    with users_lock:
+        listed = dict(users)
+    return jsonify({'users': listed}), 200
 
 @app.route('/transactions/add', methods=['POST'])
 def add_funds():
@@ -132,45 +278,118 @@ def withdraw_funds():
     if user_id not in users or amount <= 0:
         return jsonify({'message': 'Invalid user or amount'}), 400
 
-    confirmed_balance = blockchain.balances.get(user_id, 0)
-    pending_adds = sum(tx['amount'] for tx in blockchain.pending_transactions 
-                      if tx['user_id'] == user_id and tx['type'] == 'add')
-    pending_withdrawals = sum(tx['amount'] for tx in blockchain.pending_transactions 
-                            if tx['user_id'] == user_id and tx['type'] == 'withdraw')
-    available_balance = confirmed_balance + pending_adds - pending_withdrawals
-
-    if available_balance < amount:
+    if not blockchain.withdraw(user_id, amount):
         return jsonify({'message': 'Insufficient funds'}), 400
-
-    blockchain.add_transaction(user_id, amount, 'withdraw')
     return jsonify({'message': 'Transaction added to pending'}), 201
 
 @app.route('/mine', methods=['POST'])
 def mine_block():
-    last_block = blockchain.chain[-1]
-    last_proof = last_block['proof']
-    proof = blockchain.proof_of_work(last_proof)
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.create_block(proof, previous_hash)
-    return jsonify({
-        'message': 'New block mined',
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'previous_hash': block['previous_hash']
-    }), 200
+    # Mining runs in the background; poll /mine/<job_id> for the block
+    job = blockchain.miner.submit()
+    return jsonify(dict(job, message='Mining started')), 202
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def mining_status(job_id):
+    job = blockchain.miner.status(job_id)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job), 200
 
 @app.route('/users/<int:user_id>/balance', methods=['GET'])
 def get_balance(user_id):
     if user_id not in users:
         return jsonify({'message': 'User not found'}), 404
-    balance = blockchain.balances.get(user_id, 0)
-    return jsonify({'user_id': user_id, 'balance': balance}), 200
+    position = request.args.get('block', type=int)
+    if position is None:
+        balance = blockchain.balances.get(user_id, 0)
+        return jsonify({'user_id': user_id, 'balance': balance}), 200
+    with blockchain.lock:
+        if not 0 <= position < len(blockchain.chain):
+            return jsonify({'message': 'Block not found'}), 404
+        balance = blockchain.balance_at(user_id, position)
+    return jsonify({'user_id': user_id, 'block': position, 'balance': balance}), 200
+
+STREAM_CHUNK_SIZE = 1 << 16
+
+def stream_chain(start, stop, length):
+    # Same shape as before, written block by block in ~64KB pieces
+    buffer = [f'{{"length": {length}, "chain": [']
+    size = 0
+    for i in range(start, stop):
+        with blockchain.lock:
+            if i >= len(blockchain.chain):
+                break
+            block = blockchain.chain[i]
+        piece = json.dumps(block)
+        buffer.append(f',{piece}' if i > start else piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    buffer.append(']}')
+    yield ''.join(buffer)
+
+def stream_frames(start, stop):
+    # The same blocks in the binary frame format of codec.py
+    buffer = bytearray()
+    for i in range(start, stop):
+        with blockchain.lock:
+            if i >= len(blockchain.chain):
+                break
+            block = blockchain.chain[i]
+        buffer += encode_frame(block)
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer)
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
+    # Blocks at positions `from` up to (not including) `to`; the whole chain by
+    # default, as JSON or with format=binary as codec.py frames
+    length = len(blockchain.chain)
+    start = max(request.args.get('from', 0, type=int), 0)
+    stop = min(request.args.get('to', length, type=int), length)
+    if request.args.get('format') == 'binary':
+        return Response(stream_frames(start, stop), mimetype='application/octet-stream'), 200
+    return Response(stream_chain(start, stop, length), mimetype='application/json'), 200
+
+@app.route('/height', methods=['GET'])
+def get_height():
+    with blockchain.lock:
+        last_block = blockchain.chain[-1]
+        length = len(blockchain.chain)
+    return jsonify({
+        'height': last_block['index'],
+        'hash': last_block['hash'],
+        'length': length
+    }), 200
+
+@app.route('/block_hash/<int:position>', methods=['GET'])
+def get_block_hash(position):
+    with blockchain.lock:
+        if position >= len(blockchain.chain):
+            return jsonify({'message': 'Block not found'}), 404
+        block = blockchain.chain[position]
+    return jsonify({'index': block['index'], 'hash': block['hash']}), 200
+
+@app.route('/transactions/proof', methods=['GET'])
+def transaction_proof():
+    # Enough for a light client to check one transaction: the block header
+    # and the Merkle path, without the block's other transactions
+    position = request.args.get('block', type=int)
+    tx_position = request.args.get('tx', type=int)
+    with blockchain.lock:
+        if position is None or tx_position is None or not 0 <= position < len(blockchain.chain):
+            return jsonify({'message': 'Block not found'}), 404
+        block = blockchain.chain[position]
+    if 'merkle_root' not in block or not 0 <= tx_position < len(block['transactions']):
+        return jsonify({'message': 'Transaction not found'}), 404
+    header = {key: value for key, value in block.items() if key != 'transactions'}
     return jsonify({
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain)
+        'transaction': block['transactions'][tx_position],
+        'proof': merkle_proof(block['transactions'], tx_position),
+        'header': header
     }), 200
 
 @app.route('/nodes/register', methods=['POST'])
@@ -179,21 +398,25 @@ def register_nodes():
     nodes = data.get('nodes', [])
     if not nodes:
         return jsonify({'message': 'Please provide a list of nodes'}), 400
-    for node in nodes:
-        blockchain.nodes.add(node)
+    with blockchain.lock:
+        blockchain.nodes.update(nodes)
+        total_nodes = list(blockchain.nodes)
     return jsonify({
         'message': 'Nodes added',
-        'total_nodes': list(blockchain.nodes)
+        'total_nodes': total_nodes
     }), 201
 
 @app.route('/nodes/resolve', methods=['GET'])
 def consensus():
     replaced = blockchain.resolve_conflicts()
+    with blockchain.lock:
+        chain = list(blockchain.chain)
     if replaced:
-        response = {'message': 'Chain replaced', 'new_chain': blockchain.chain}
+        response = {'message': 'Chain replaced', 'new_chain': chain}
     else:
-        response = {'message': 'Chain authoritative', 'chain': blockchain.chain}
+        response = {'message': 'Chain authoritative', 'chain': chain}
     return jsonify(response), 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    # Request threads share one Blockchain; its locks keep them consistent
+    app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,186 @@
+import json
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+import requests
+
+from app import app, blockchain
+from codec import VERSION
+from merkle import merkle_root
+from verify import INITIAL_BITS, block_hash, expected_bits, search_proofs
+
+# Microbenchmarks of mining and validation, then request latencies against
+# the app through Flask's test client. /nodes/resolve syncs from a second
+# node started on --peer-port. Results are printed and, with -o, written
+# as JSON for comparing runs.
+
+def summary(samples):
+    samples = sorted(samples)
+    percentile = lambda p: samples[min(int(p * len(samples)), len(samples) - 1)] * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': percentile(0.5),
+        'p99_ms': percentile(0.99),
+    }
+
+def timed(call, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = call()
+        samples.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{response.status_code}: {response.get_data(as_text=True)}')
+    return summary(samples)
+
+def bench_proof_of_work(rounds, bits):
+    attempts = 0
+    start = time.perf_counter()
+    for last_proof in range(rounds):
+        attempts += blockchain.proof_of_work(last_proof, bits) + 1
+    elapsed = time.perf_counter() - start
+    return {'bits': bits, 'attempts': attempts, 'hashes_per_sec': attempts / elapsed}
+
+def build_chain(size):
+    # Blocks 1000s apart, so retargeting soon settles on the lowest bits
+    # and the chain is cheap to mine
+    chain = [blockchain.chain[0]]
+    moment = datetime.fromisoformat(chain[0]['timestamp'])
+    while len(chain) < size:
+        previous = chain[-1]
+        bits = expected_bits(chain)
+        transactions = [{'user_id': 1, 'amount': 1, 'type': 'add', 'timestamp': str(moment)}]
+        block = {
+            'version': VERSION,
+            'index': len(chain) + 1,
+            'timestamp': str(moment + timedelta(seconds=1000 * len(chain))),
+            'transactions': transactions,
+            'merkle_root': merkle_root(transactions),
+            'proof': search_proofs(previous['proof'], 0, 1 << 64, bits),
+            'bits': bits,
+            'previous_hash': block_hash(previous),
+        }
+        block['hash'] = block_hash(block)
+        chain.append(block)
+    return chain
+
+def bench_valid_chain(chain, sizes):
+    results = {}
+    for size in sizes:
+        start = time.perf_counter()
+        if not blockchain.valid_chain(chain[:size]):
+            raise RuntimeError(f'generated chain of {size} blocks is invalid')
+        elapsed = time.perf_counter() - start
+        results[str(size)] = {'seconds': elapsed, 'blocks_per_sec': size / elapsed}
+    return results
+
+def wait_for_job(get, job):
+    while job['status'] in ('queued', 'mining'):
+        time.sleep(0.005)
+        job = get(job['job_id'])
+    if job['status'] != 'mined':
+        raise RuntimeError(f"mining job ended {job['status']}")
+
+def start_peer(port):
+    peer = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/height', timeout=1)
+            return peer
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    peer.terminate()
+    raise RuntimeError(f'peer on port {port} did not start')
+
+def bench_http(requests_per_route, mine_jobs, resolves, peer_port):
+    client = app.test_client()
+    user_ids = [client.post('/users').get_json()['user_id'] for _ in range(10)]
+    results = {}
+    # Separate counters, so withdrawals start back at the first user and
+    # each user has been paid before it is charged
+    adds, withdrawals = iter(range(1 << 62)), iter(range(1 << 62))
+
+    def add():
+        user_id = user_ids[next(adds) % len(user_ids)]
+        return client.post('/transactions/add', json={'user_id': user_id, 'amount': 10})
+    results['POST /transactions/add'] = timed(add, requests_per_route)
+
+    def withdraw():
+        user_id = user_ids[next(withdrawals) % len(user_ids)]
+        return client.post('/transactions/withdraw', json={'user_id': user_id, 'amount': 1})
+    results['POST /transactions/withdraw'] = timed(withdraw, requests_per_route)
+
+    # Every resolve adopts one block the peer just mined
+    peer = start_peer(peer_port)
+    base = f'http://127.0.0.1:{peer_port}'
+    try:
+        client.post('/nodes/register', json={'nodes': [f'127.0.0.1:{peer_port}']})
+        samples = []
+        for _ in range(resolves):
+            job = requests.post(f'{base}/mine').json()
+            wait_for_job(lambda job_id: requests.get(f'{base}/mine/{job_id}').json(), job)
+            start = time.perf_counter()
+            response = client.get('/nodes/resolve')
+            samples.append(time.perf_counter() - start)
+            if response.get_json()['message'] != 'Chain replaced':
+                raise RuntimeError('resolve did not adopt the peer block')
+        results['GET /nodes/resolve'] = summary(samples)
+    finally:
+        peer.terminate()
+        peer.wait()
+        with blockchain.lock:
+            blockchain.nodes.clear()
+
+    # /mine answers at once; time_to_mined covers the background job too
+    requests_samples, mined_samples = [], []
+    for _ in range(mine_jobs):
+        start = time.perf_counter()
+        job = client.post('/mine').get_json()
+        requests_samples.append(time.perf_counter() - start)
+        wait_for_job(lambda job_id: client.get(f'/mine/{job_id}').get_json(), job)
+        mined_samples.append(time.perf_counter() - start)
+    results['POST /mine'] = summary(requests_samples)
+    results['POST /mine time_to_mined'] = summary(mined_samples)
+
+    with blockchain.lock:
+        position = next(p for p in reversed(range(len(blockchain.chain))) if blockchain.chain[p]['transactions'])
+    results['GET /transactions/proof'] = timed(
+        lambda: client.get('/transactions/proof', query_string={'block': position, 'tx': 0}), requests_per_route)
+    return results
+
+def report(results, indent=''):
+    for name, value in results.items():
+        if isinstance(value, dict) and all(isinstance(v, dict) for v in value.values()):
+            print(f'{indent}{name}')
+            report(value, indent + '  ')
+        elif isinstance(value, dict):
+            print(f'{indent}{name}: ' + ', '.join(f'{key} {v:,.3f}' if isinstance(v, float) else f'{key} {v}' for key, v in value.items()))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--sizes', nargs='*', default=[1000, 10000], type=int, help='Chain lengths to validate')
+    parser.add_argument('-r', '--rounds', default=20, type=int, help='Proofs to search for the hash rate')
+    parser.add_argument('-n', '--requests', default=500, type=int, help='Requests per route')
+    parser.add_argument('-m', '--mine-jobs', default=10, type=int)
+    parser.add_argument('--resolves', default=10, type=int)
+    parser.add_argument('--peer-port', default=5999, type=int)
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {
+        'proof_of_work': bench_proof_of_work(args.rounds, INITIAL_BITS),
+        'valid_chain': bench_valid_chain(build_chain(max(args.sizes)), args.sizes),
+        'http': bench_http(args.requests, args.mine_jobs, args.resolves, args.peer_port),
+    }
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'suite': 'wallet-blockchain', 'python': platform.python_version(), 'results': results}, f, indent=2)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import struct
+from datetime import datetime, timedelta
+
+# Blocks with 'version': 1 are hashed over this fixed binary header; the
+# transactions are committed to through merkle_root. Blocks without a
+# version are legacy blocks, hashed over their sort_keys JSON.
+VERSION = 1
+# version, index, timestamp (microseconds since EPOCH), proof, bits, merkle root, previous hash
+HEADER = struct.Struct('>BQqQH32s32s')
+# A full block for storage or the wire: the header, then the length of the
+# transactions payload and the payload itself. On the wire every block is a
+# frame: its length, then the block, or a 0 byte and JSON for legacy blocks
+PAYLOAD_LENGTH = struct.Struct('>I')
+FRAME_LENGTH = struct.Struct('>I')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+def pack_timestamp(timestamp):
+    # Only timestamps that str(datetime) gives back unchanged are canonical
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is not None or str(moment) != timestamp:
+        raise ValueError(f'timestamp {timestamp!r} is not canonical')
+    return (moment - EPOCH) // MICROSECOND
+
+def encode_header(block):
+    return HEADER.pack(
+        VERSION,
+        block['index'],
+        pack_timestamp(block['timestamp']),
+        block['proof'],
+        block['bits'],
+        bytes.fromhex(block['merkle_root']),
+        bytes.fromhex(block['previous_hash']),
+    )
+
+def encode_block(block):
+    payload = json.dumps(block['transactions'], sort_keys=True, separators=(',', ':')).encode()
+    return encode_header(block) + PAYLOAD_LENGTH.pack(len(payload)) + payload
+
+def decode_block(data):
+    version, index, timestamp, proof, bits, merkle_root, previous_hash = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'unknown block version {version}')
+    (length,) = PAYLOAD_LENGTH.unpack_from(data, HEADER.size)
+    start = HEADER.size + PAYLOAD_LENGTH.size
+    return {
+        'version': version,
+        'index': index,
+        'timestamp': str(EPOCH + timestamp * MICROSECOND),
+        'transactions': json.loads(data[start:start + length]),
+        'merkle_root': merkle_root.hex(),
+        'proof': proof,
+        'bits': bits,
+        'previous_hash': previous_hash.hex(),
+        'hash': hashlib.sha256(data[:HEADER.size]).hexdigest(),
+    }
+
+def legacy_hash(block):
+    # Blocks with a merkle_root commit to their transactions through it, so
+    # only the header is hashed; older blocks hash their full JSON
+    if 'merkle_root' in block:
+        block = {key: value for key, value in block.items() if key != 'transactions'}
+    block_string = json.dumps(block, sort_keys=True).encode()
+    return hashlib.sha256(block_string).hexdigest()
+
+def block_hash(block):
+    version = block.get('version', 0)
+    if version == 0:
+        return legacy_hash(block)
+    if version == VERSION:
+        return hashlib.sha256(encode_header(block)).hexdigest()
+    raise ValueError(f'unknown block version {version}')
+
+def encode_frame(block):
+    if block.get('version', 0) == VERSION:
+        body = encode_block(block)
+    else:
+        body = b'\x00' + json.dumps(block).encode()
+    return FRAME_LENGTH.pack(len(body)) + body
+
+def iter_frames(chunks):
+    # Decode a stream of frames one block at a time, e.g. from response.iter_content()
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while len(buffer) - pos >= FRAME_LENGTH.size:
+            (length,) = FRAME_LENGTH.unpack_from(buffer, pos)
+            end = pos + FRAME_LENGTH.size + length
+            if len(buffer) < end:
+                break
+            body = bytes(buffer[pos + FRAME_LENGTH.size:end])
+            yield json.loads(body[1:]) if body[0] == 0 else decode_block(body)
+            pos = end
+        del buffer[:pos]
+    if buffer:
+        raise ValueError('truncated frame at end of stream')
@@ -0,0 +1,111 @@
+import json
+from array import array
+from datetime import datetime, timedelta
+
+from codec import VERSION
+
+BLOCK_KEYS = ('version', 'index', 'timestamp', 'transactions', 'merkle_root', 'proof', 'bits', 'previous_hash', 'hash')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+class ChainColumns:
+    """The wallet chain stored column by column instead of as a list of dicts.
+
+    Proofs, difficulty bits and timestamps live in packed arrays, hashes and Merkle roots as
+    32 raw bytes, and
+    the transactions of every block as compact JSON in one buffer. Values that
+    don't fit a column (the genesis '0' previous hash, a peer's odd timestamp)
+    are kept as-is in `odd`, and so are whole blocks of another version.
+    Indexing rebuilds the same dict create_block made.
+    """
+
+    def __init__(self, blocks=()):
+        self.proofs = array('Q')
+        self.bits = array('H')
+        self.timestamps = array('q')
+        self.hashes = bytearray()
+        self.previous_hashes = bytearray()
+        self.merkle_roots = bytearray()
+        self.payload = bytearray()
+        self.payload_ends = array('Q')
+        self.odd = {}
+        for block in blocks: self.append(block)
+
+    def __len__(self):
+        return len(self.proofs)
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError('chain index out of range')
+        odd = self.odd.get(i, {})
+        if 'block' in odd: return odd['block']
+        start = self.payload_ends[i - 1] if i else 0
+        block = {
+            'version': VERSION,
+            'index': i + 1,
+            'timestamp': str(EPOCH + self.timestamps[i] * MICROSECOND),
+            'transactions': json.loads(self.payload[start:self.payload_ends[i]]),
+            'merkle_root': self.merkle_roots[32 * i:32 * i + 32].hex(),
+            'proof': self.proofs[i],
+            'bits': self.bits[i],
+            'previous_hash': self.previous_hashes[32 * i:32 * i + 32].hex(),
+            'hash': self.hashes[32 * i:32 * i + 32].hex(),
+        }
+        block.update(odd)
+        return block
+
+    def truncate(self, length):
+        if length >= len(self): return
+        end = self.payload_ends[length - 1] if length else 0
+        del self.proofs[length:], self.bits[length:], self.timestamps[length:], self.payload_ends[length:]
+        del self.hashes[32 * length:], self.previous_hashes[32 * length:], self.merkle_roots[32 * length:]
+        del self.payload[end:]
+        self.odd = {i: odd for i, odd in self.odd.items() if i < length}
+
+    def append(self, block):
+        position = len(self)
+        if set(block) != set(BLOCK_KEYS) or block['version'] != VERSION:
+            self.odd[position] = {'block': block}
+            block = {}
+        odd = {}
+        if block and block['index'] != position + 1:
+            odd['index'] = block['index']
+        self.timestamps.append(self._pack_timestamp(block.get('timestamp'), odd))
+        proof = block.get('proof', 0)
+        if isinstance(proof, int) and 0 <= proof < 1 << 64: self.proofs.append(proof)
+        else:
+            self.proofs.append(0)
+            odd['proof'] = proof
+        bits = block.get('bits', 0)
+        if isinstance(bits, int) and 0 <= bits < 1 << 16: self.bits.append(bits)
+        else:
+            self.bits.append(0)
+            odd['bits'] = bits
+        self.previous_hashes += self._pack_hash('previous_hash', block.get('previous_hash'), odd)
+        self.hashes += self._pack_hash('hash', block.get('hash'), odd)
+        self.merkle_roots += self._pack_hash('merkle_root', block.get('merkle_root'), odd)
+        self.payload += json.dumps(block.get('transactions', []), separators=(',', ':')).encode()
+        self.payload_ends.append(len(self.payload))
+        if block and odd: self.odd[position] = odd
+
+    @staticmethod
+    def _pack_timestamp(timestamp, odd):
+        try:
+            moment = datetime.fromisoformat(timestamp)
+            if moment.tzinfo is None and str(moment) == timestamp: return (moment - EPOCH) // MICROSECOND
+        except (TypeError, ValueError): pass
+        odd['timestamp'] = timestamp
+        return 0
+
+    @staticmethod
+    def _pack_hash(key, value, odd):
+        try:
+            digest = bytes.fromhex(value)
+            if len(digest) == 32 and digest.hex() == value: return digest
+        except (TypeError, ValueError): pass
+        odd[key] = value
+        return bytes(32)
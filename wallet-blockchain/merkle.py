@@ -0,0 +1,41 @@
+import hashlib
+import json
+
+# Leaves and inner nodes are hashed with different prefixes so a leaf can
+# never be passed off as a node
+LEAF = b"\x00"
+NODE = b"\x01"
+
+def leaf_hash(item):
+    return hashlib.sha256(LEAF + json.dumps(item, sort_keys=True).encode()).digest()
+
+def next_level(level):
+    # An odd last node moves up unchanged instead of being paired with itself
+    paired = [hashlib.sha256(NODE + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2: paired.append(level[-1])
+    return paired
+
+def merkle_root(items):
+    level = [leaf_hash(item) for item in items]
+    if not level: return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1: level = next_level(level)
+    return level[0].hex()
+
+def merkle_proof(items, position):
+    # Sibling hashes from the leaf up, each tagged with the side it sits on;
+    # levels where the node is a promoted odd one add nothing
+    level = [leaf_hash(item) for item in items]
+    proof = []
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level): proof.append(["left" if sibling < position else "right", level[sibling].hex()])
+        level = next_level(level)
+        position //= 2
+    return proof
+
+def verify_proof(item, proof, root):
+    node = leaf_hash(item)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        node = hashlib.sha256(NODE + sibling + node if side == "left" else NODE + node + sibling).digest()
+    return node.hex() == root
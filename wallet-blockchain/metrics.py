@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Histogram bucket bounds in seconds, from sub-millisecond requests to slow syncs
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+class Metrics:
+    """Counters and histograms for /metrics, in the Prometheus text format.
+
+    A series is a metric name plus its labels and is created on first use.
+    Gauges are callbacks read only when /metrics is scraped. With METRICS=0
+    in the environment, or enabled=False, inc(), observe() and timer() do
+    nothing and /metrics is not served.
+    """
+
+    def __init__(self, enabled=os.environ.get('METRICS', '1') != '0', buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        # Per series: a count for each bucket and one past the last, then the sum
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(self.buckets) + 2)
+            counts[bucket] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def render(self):
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {key: list(counts) for key, counts in series.items()} for name, series in self.histograms.items()}
+        lines = []
+        for name, read in sorted(self.gauges.items()):
+            lines += [f'# TYPE {name} gauge', f'{name} {read()}']
+        for name, series in sorted(counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            lines += [f'{name}{label_text(key)} {value}' for key, value in sorted(series.items())]
+        for name, series in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, counts in sorted(series.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    total += count
+                    lines.append(f'{name}_bucket{label_text(key + (("le", bound),))} {total}')
+                lines += [f'{name}_sum{label_text(key)} {counts[-1]}', f'{name}_count{label_text(key)} {total}']
+        return '\n'.join(lines) + '\n'
+
+# Shared by the app, the miner and the peer client
+metrics = Metrics()
@@ -0,0 +1,96 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import metrics
+from verify import search_proofs
+
+class Miner:
+    """Background mining jobs for /mine.
+
+    Jobs run one after another on a dedicated thread. The proof is searched
+    on a worker process in chunks of `chunk_size` proofs, so request threads
+    keep running. The difficulty is the retargeted bits for the next block.
+    Between chunks the job checks whether it was cancelled.
+    The block is sealed with whatever transactions are pending when the
+    proof is found. If the tip moved in the meantime, the job mines again on
+    the new tip. The last `capacity` jobs are kept for status().
+    """
+
+    def __init__(self, blockchain, chunk_size=100000, capacity=1000):
+        self.blockchain = blockchain
+        self.chunk_size = chunk_size
+        self.capacity = capacity
+        self.jobs = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.runner = ThreadPoolExecutor(max_workers=1)
+        self.pool = None
+
+    def submit(self):
+        job = {'job_id': uuid.uuid4().hex, 'status': 'queued'}
+        with self.lock:
+            self.jobs[job['job_id']] = job
+            if len(self.jobs) > self.capacity:
+                self.jobs.popitem(last=False)
+            generation = self.generation
+        self.runner.submit(self.run, job, generation)
+        return dict(job)
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def cancel(self):
+        # Every queued or running job ends as 'cancelled'; the pending
+        # transactions stay in the mempool for the next job
+        with self.lock:
+            self.generation += 1
+
+    def cancelled(self, generation):
+        return generation != self.generation
+
+    def update(self, job, **fields):
+        with self.lock:
+            job.update(fields)
+        if fields.get('status') in ('mined', 'cancelled'):
+            metrics.inc('wallet_mining_jobs_total', status=fields['status'])
+
+    def run(self, job, generation):
+        blockchain = self.blockchain
+        started = time.perf_counter()
+        while True:
+            with blockchain.lock:
+                if self.cancelled(generation):
+                    return self.update(job, status='cancelled')
+                last_block = blockchain.chain[-1]
+                bits = blockchain.next_bits()
+            self.update(job, status='mining', bits=bits)
+            proof = self.search(last_block['proof'], bits, generation)
+            with blockchain.lock:
+                if proof is None or self.cancelled(generation):
+                    return self.update(job, status='cancelled')
+                if blockchain.chain[-1]['hash'] == last_block['hash']:
+                    block = blockchain.create_block(proof, blockchain.hash(last_block), bits)
+                    metrics.observe('wallet_mining_seconds', time.perf_counter() - started)
+                    return self.update(
+                        job,
+                        status='mined',
+                        index=block['index'],
+                        transactions=block['transactions'],
+                        previous_hash=block['previous_hash']
+                    )
+
+    def search(self, last_proof, bits, generation):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=1)
+        start = 0
+        while not self.cancelled(generation):
+            proof = self.pool.submit(search_proofs, last_proof, start, start + self.chunk_size, bits).result()
+            if proof is not None:
+                return proof
+            start += self.chunk_size
+        return None
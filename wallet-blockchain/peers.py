@@ -0,0 +1,53 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from metrics import metrics
+
+class PeerClient:
+    """HTTP calls to peers with one keep-alive session per peer.
+
+    Every call has a timeout and is retried with exponential backoff on
+    connection errors and 5xx answers. fan_out sends the same call to many
+    peers on a bounded thread pool, so it takes about as long as the
+    slowest peer.
+    """
+
+    def __init__(self, timeout=2.0, retries=2, backoff=0.1, max_workers=16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def session(self, node):
+        with self.lock:
+            if node not in self.sessions:
+                self.sessions[node] = requests.Session()
+            return self.sessions[node]
+
+    def request(self, method, node, path, **kwargs):
+        # The response, or None once every attempt failed
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.timer('wallet_peer_request_seconds', node=node):
+                    response = self.session(node).request(method, f'http://{node}{path}', **kwargs)
+                if response.status_code < 500:
+                    return response
+            except requests.exceptions.RequestException:
+                pass
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        metrics.inc('wallet_peer_failures_total', node=node)
+        return None
+
+    def get(self, node, path, **kwargs):
+        return self.request('GET', node, path, **kwargs)
+
+    def fan_out(self, method, nodes, path, **kwargs):
+        futures = {node: self.pool.submit(self.request, method, node, path, **kwargs) for node in list(nodes)}
+        return {node: future.result() for node, future in futures.items()}
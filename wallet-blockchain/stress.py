@@ -0,0 +1,83 @@
+import requests
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from verify import block_hash
+
+# Base URL of the Flask app
+BASE_URL = 'http://127.0.0.1:5000'
+
+USERS = 20
+DEPOSIT = 100
+WITHDRAWAL = 30
+ATTEMPTS_PER_USER = 10
+THREADS = 16
+
+def register(_):
+    return requests.post(f'{BASE_URL}/users').json()['user_id']
+
+def withdraw(user_id):
+    data = {'user_id': user_id, 'amount': WITHDRAWAL}
+    response = requests.post(f'{BASE_URL}/transactions/withdraw', json=data)
+    return user_id, response.status_code == 201
+
+def mine(_):
+    # Waits for the background job; returns its final status
+    job = requests.post(f'{BASE_URL}/mine').json()
+    while job['status'] in ('queued', 'mining'):
+        time.sleep(0.05)
+        job = requests.get(f"{BASE_URL}/mine/{job['job_id']}").json()
+    return job['status']
+
+def stress():
+    pool = ThreadPoolExecutor(max_workers=THREADS)
+    failures = []
+
+    # Register users from many threads at once; every id must be new and listed
+    user_ids = list(pool.map(register, range(USERS)))
+    listed = requests.post(f'{BASE_URL}/users/list').json()['users']
+    if len(set(user_ids)) != USERS:
+        failures.append(f"Duplicate user ids: {sorted(user_ids)}")
+    missing = [user_id for user_id in user_ids if str(user_id) not in listed]
+    if missing:
+        failures.append(f"Users missing from the list: {missing}")
+    print(f"Registered {USERS} users concurrently")
+
+    for user_id in user_ids:
+        requests.post(f'{BASE_URL}/transactions/add', json={'user_id': user_id, 'amount': DEPOSIT})
+    mine(None)
+    start = {user_id: requests.get(f'{BASE_URL}/users/{user_id}/balance').json()['balance'] for user_id in user_ids}
+
+    # Withdraw more than anyone has, with miners racing the withdrawals
+    attempts = [user_id for user_id in user_ids for _ in range(ATTEMPTS_PER_USER)]
+    miners = [pool.submit(mine, None) for _ in range(4)]
+    results = list(pool.map(withdraw, attempts))
+    if any(future.result() != 'mined' for future in miners):
+        failures.append("A concurrent mining job failed")
+    mine(None)
+    print(f"Sent {len(attempts)} withdrawals from {THREADS} threads")
+
+    accepted = {user_id: 0 for user_id in user_ids}
+    for user_id, ok in results:
+        accepted[user_id] += ok
+    for user_id in user_ids:
+        balance = requests.get(f'{BASE_URL}/users/{user_id}/balance').json()['balance']
+        expected = start[user_id] - accepted[user_id] * WITHDRAWAL
+        if balance < 0 or balance != expected:
+            failures.append(f"User {user_id}: balance {balance}, expected {expected}")
+        if accepted[user_id] != start[user_id] // WITHDRAWAL:
+            failures.append(f"User {user_id}: {accepted[user_id]} withdrawals accepted, expected {start[user_id] // WITHDRAWAL}")
+
+    chain = requests.get(f'{BASE_URL}/chain').json()['chain']
+    for previous, block in zip(chain, chain[1:]):
+        if block['previous_hash'] != block_hash(previous):
+            failures.append(f"Block {block['index']} does not link to block {previous['index']}")
+
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+    print("No lost users, no double spends, chain links intact")
+
+if __name__ == '__main__':
+    stress()
@@ -4,6 +4,14 @@ import time
 # Base URL of the Flask app
 BASE_URL = 'http://127.0.0.1:5000'
 
+def mine():
+    # /mine answers with a job id at once; poll it until the block is sealed
+    job = requests.post(f'{BASE_URL}/mine').json()
+    while job['status'] in ('queued', 'mining'):
+        time.sleep(0.05)
+        job = requests.get(f"{BASE_URL}/mine/{job['job_id']}").json()
+    return job
+
 def simulate_transactions():
     # Register three users
     user_ids = []
@@ -22,8 +30,7 @@ def simulate_transactions():
 
     # Mine a block to process the add transactions
     print("\nMining block to process add transactions...")
-    response = requests.post(f'{BASE_URL}/mine')
-    mined_block = response.json()
+    mined_block = mine()
     print(f"Mined block {mined_block['index']} with transactions: {mined_block['transactions']}\n")
 
     # Check balances after adding funds
@@ -43,8 +50,7 @@ def simulate_transactions():
 
     # Mine another block to process withdrawals
     print("\nMining block to process withdrawal transactions...")
-    response = requests.post(f'{BASE_URL}/mine')
-    mined_block = response.json()
+    mined_block = mine()
     print(f"Mined block {mined_block['index']} with transactions: {mined_block['transactions']}\n")
 
     # Check balances after withdrawals
@@ -0,0 +1,169 @@
+import hashlib
+import math
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import chain as join, islice
+
+from codec import VERSION, block_hash
+from merkle import merkle_root
+
+CHUNK_SIZE = 2000
+
+# A proof is valid when sha256(f'{last_proof}{proof}') has `bits` leading
+# zero bits. Blocks record their bits, retargeted every block so blocks
+# come about TARGET_INTERVAL seconds apart; 16 is the old four hex zeros
+# and what blocks without 'bits' were mined at
+INITIAL_BITS = 16
+MIN_BITS = 8
+MAX_BITS = 256
+TARGET_INTERVAL = 2.0
+RETARGET_WINDOW = 10
+MAX_STEP = 1
+
+def proof_target(bits):
+    return ((1 << 256 - bits) - 1).to_bytes(32, 'big')
+
+def valid_proof(last_proof, proof, bits=INITIAL_BITS):
+    guess = f'{last_proof}{proof}'.encode()
+    return hashlib.sha256(guess).digest() <= proof_target(bits)
+
+def search_proofs(last_proof, start, stop, bits=INITIAL_BITS):
+    # The first valid proof in [start, stop), or None; the last proof is
+    # hashed once and the hash state copied for every attempt
+    midstate = hashlib.sha256(str(last_proof).encode())
+    target = proof_target(bits)
+    for proof in range(start, stop):
+        guess = midstate.copy()
+        guess.update(b'%d' % proof)
+        if guess.digest() <= target: return proof
+    return None
+
+def retarget(window):
+    """Bits for the block after `window`, a list of (seconds, bits) of recent blocks.
+
+    The work done over the window (2 ** bits per block) divided by the time
+    it took estimates the hash rate. The result is the bits that take about
+    TARGET_INTERVAL seconds at that rate, at most MAX_STEP from the last block's.
+    """
+    if len(window) < 2: return INITIAL_BITS
+    span = max(window[-1][0] - window[0][0], 1e-6)
+    work = sum(2 ** bits for _, bits in list(window)[1:])
+    ideal = round(math.log2(work / span * TARGET_INTERVAL))
+    last = window[-1][1]
+    ideal = max(last - MAX_STEP, min(last + MAX_STEP, ideal))
+    return max(MIN_BITS, min(MAX_BITS, ideal))
+
+def retarget_entry(block):
+    # (seconds, bits) of a block as retarget() wants it; timestamps are read
+    # as UTC so every node gets the same spans whatever its local zone
+    moment = datetime.fromisoformat(block['timestamp']).replace(tzinfo=timezone.utc)
+    return moment.timestamp(), block.get('bits', INITIAL_BITS)
+
+def expected_bits(blocks):
+    # Bits for the block after `blocks`, judged by the last RETARGET_WINDOW + 1 of them
+    return retarget([retarget_entry(block) for block in blocks[-RETARGET_WINDOW - 1:]])
+
+def check_chunk(previous_proof, chunk):
+    # Hashes every block of the chunk and returns them with the offset of the
+    # first bad proof, hash or Merkle root; previous_proof is None for the genesis chunk
+    hashes = []
+    for offset, block in enumerate(chunk):
+        try:
+            hashes.append(block_hash(block))
+        except (KeyError, TypeError, ValueError, struct.error):
+            return hashes + [None] * (len(chunk) - offset), offset
+    for offset, block in enumerate(chunk):
+        # Legacy blocks stored a hash of themselves taken before 'hash' was set,
+        # which links never used; version 1 hashes are the ones links point to
+        if block.get('version', 0) == VERSION and block.get('hash') != hashes[offset]:
+            return hashes, offset
+        if previous_proof is not None and not valid_proof(previous_proof, block['proof'], block.get('bits', INITIAL_BITS)):
+            return hashes, offset
+        if 'merkle_root' in block and block['merkle_root'] != merkle_root(block['transactions']):
+            return hashes, offset
+        previous_proof = block['proof']
+    return hashes, None
+
+def _chunks(chain, chunk_size):
+    blocks = iter(chain)
+    previous_proof = None
+    position = 0
+    while True:
+        chunk = list(islice(blocks, chunk_size))
+        if not chunk: return
+        yield position, previous_proof, chunk
+        previous_proof = chunk[-1]['proof']
+        position += len(chunk)
+
+def _results(chunks, workers):
+    if workers == 1:
+        for position, previous_proof, chunk in chunks:
+            yield position, chunk, check_chunk(previous_proof, chunk)
+        return
+    pool = ProcessPoolExecutor(workers)
+    in_flight = deque()
+    try:
+        for position, previous_proof, chunk in chunks:
+            in_flight.append((position, chunk, pool.submit(check_chunk, previous_proof, chunk)))
+            if len(in_flight) > 2 * workers:
+                position, chunk, future = in_flight.popleft()
+                yield position, chunk, future.result()
+        while in_flight:
+            position, chunk, future = in_flight.popleft()
+            yield position, chunk, future.result()
+    finally: pool.shutdown(cancel_futures=True)
+
+def find_invalid_block(chain, workers=None, chunk_size=CHUNK_SIZE, start=0):
+    """Return the position of the first block with a bad link, proof, difficulty or Merkle root, or None.
+
+    Block hashes are computed in chunks on a process pool (in-process for a
+    single chunk); chain can be any iterable of block dicts. A block's bits
+    are checked when the blocks before it cover its retarget window, so a
+    partial chain should start RETARGET_WINDOW + 1 blocks before the ones
+    to check, with `start` its position in the full chain.
+    """
+    chunks = _chunks(chain, chunk_size)
+    head = list(islice(chunks, 2))
+    workers = 1 if len(head) < 2 else workers or os.cpu_count()
+    results = _results(join(head, chunks), workers)
+
+    previous_hash = None
+    window = deque(maxlen=RETARGET_WINDOW + 1)
+    seen = set()
+    for position, chunk, (hashes, bad_block) in results:
+        links = [block['previous_hash'] for block in chunk]
+        expected = [links[0] if position == 0 else previous_hash] + hashes[:-1]
+        bad = [] if bad_block is None else [bad_block]
+        if links != expected:
+            bad.append(next(i for i, (a, b) in enumerate(zip(links, expected)) if a != b))
+        bad_bits = _first_bad_bits(chunk, start + position, window, seen)
+        if bad_bits is not None:
+            bad.append(bad_bits)
+        if bad:
+            results.close()
+            return position + min(bad)
+        previous_hash = hashes[-1]
+    return None
+
+def _first_bad_bits(chunk, position, window, seen):
+    # Offset of the first block whose bits aren't what retargeting gives,
+    # or whose timestamp can't be read. Only the legacy prefix of a chain may
+    # leave out 'bits' or 'version': once a block has them, a later block
+    # without them would be checked at INITIAL_BITS or hashed as JSON.
+    # position is where the chunk starts in the full chain; window and seen
+    # carry over between chunks
+    for offset, block in enumerate(chunk):
+        try: entry = retarget_entry(block)
+        except (TypeError, ValueError): return offset
+        for key, present in (('bits', 'bits' in block), ('version', block.get('version', 0) != 0)):
+            if present:
+                seen.add(key)
+            elif key in seen:
+                return offset
+        if 'bits' in block and len(window) >= min(position + offset, RETARGET_WINDOW + 1):
+            if block['bits'] != retarget(window): return offset
+        window.append(entry)
+    return None